@@ -0,0 +1,226 @@
+"""Benchmarks the NACSA Tunes engine on synthetic MP3 libraries, without a display or a sound card.
+
+    python benchmark.py                       # 1k, 10k and 100k tracks
+    python benchmark.py --sizes 1000 --json results.json
+    python benchmark.py --baseline results.json --tolerance 0.25
+
+Libraries are generated once under --dir and reused by later runs. Every size is measured in a fresh process
+so that its peak RSS (peak working set on Windows) is its own. With --baseline, any timing more than
+--tolerance slower than the baseline's (and by more than 1 ms, or 1 MB of RSS) is reported and the exit status
+is 1.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from mutagen.id3 import ID3, APIC, TALB, TIT2, TPE1, TPOS, TRCK
+from PIL import Image
+
+import nacsa_engine as engine
+
+# One silent MPEG-1 Layer III frame (128 kbit/s, 44.1 kHz); a few of them make a valid, very short track.
+MP3_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+FRAMES_PER_TRACK = 8
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+WORDS = ("love", "night", "Día", "fire", "river", "blue", "Ölümsüz", "dream", "summer", "ghost", "heart", "city",
+         "light", "señor", "road", "rain", "gold", "echo", "wild", "moon", "stone", "Café", "star", "home")
+
+
+def generate_library(root, size, seed=1):
+    """Writes size tagged tracks as root/<artist>/<album>/<nn> - <title>.mp3, each album sharing one cover."""
+    rng = random.Random(seed)
+    audio = MP3_FRAME * FRAMES_PER_TRACK
+    for album_no in range((size + TRACKS_PER_ALBUM - 1) // TRACKS_PER_ALBUM):
+        artist = f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {album_no // ALBUMS_PER_ARTIST}"
+        album = f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {album_no}"
+        cover = io.BytesIO()
+        Image.new("RGB", (600, 600), (rng.randrange(256), rng.randrange(256), rng.randrange(256))).save(cover, "JPEG")
+        album_dir = os.path.join(root, artist, album)
+        os.makedirs(album_dir, exist_ok=True)
+        for track_no in range(1, min(TRACKS_PER_ALBUM, size - album_no * TRACKS_PER_ALBUM) + 1):
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).capitalize()
+            path = os.path.join(album_dir, f"{track_no:02d} - {title}.mp3")
+            with open(path, "wb") as f:
+                f.write(audio)
+            tags = ID3()
+            tags.add(TIT2(encoding=3, text=title))
+            tags.add(TPE1(encoding=3, text=artist))
+            tags.add(TALB(encoding=3, text=album))
+            tags.add(TRCK(encoding=3, text=f"{track_no}/{TRACKS_PER_ALBUM}"))
+            tags.add(TPOS(encoding=3, text="1/1"))
+            tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover.getvalue()))
+            tags.save(path)
+
+
+def library_dir(base, size):
+    """Returns the directory of a generated library of size tracks, generating it first if needed."""
+    root = os.path.join(base, f"library_{size}")
+    marker = os.path.join(root, ".complete")
+    if not os.path.exists(marker):
+        shutil.rmtree(root, ignore_errors=True)
+        started = time.perf_counter()
+        generate_library(root, size)
+        open(marker, "w").close()
+        print(f"  generated {size} tracks in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    return root
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+def scan(library, roots):
+    library.load(roots)
+    while not library.drain(budget=1.0):
+        time.sleep(0.005)
+
+
+def restore(library, session):
+    library.restore(session)
+    while not library.drain(budget=1.0):
+        time.sleep(0.005)
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, or None where it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        return peak_working_set_mb() if sys.platform == "win32" else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def peak_working_set_mb():
+    """Windows' counterpart of the peak RSS: the peak working set, from GetProcessMemoryInfo."""
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage",
+                                                 "QuotaPagedPoolUsage", "QuotaPeakNonPagedPoolUsage",
+                                                 "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+    kernel32, psapi = ctypes.WinDLL("kernel32"), ctypes.WinDLL("psapi")
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    counters = ProcessMemoryCounters(cb=ctypes.sizeof(ProcessMemoryCounters))
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize / 2 ** 20
+
+
+def track_bytes(index_path, roots, size):
+    """Returns the heap bytes per track held by the records of an indexed library.
+
+    The artist and album tables are already filled by the scans, so their strings are not counted again.
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = engine.LibraryIndex(index_path).load(roots)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(state.songs()) == size
+    return used / size
+
+
+def measure(root, size):
+    """Runs every benchmark on one library and returns {metric: value}; times are in milliseconds."""
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        index_path = os.path.join(work, "library_index.db")
+        library = engine.Library(index_path, os.path.join(work, "playlists.db"))
+        results["scan_cold_ms"] = timed(scan, library, [root])
+        assert len(library.tracks) == size, f"scanned {len(library.tracks)} of {size} tracks"
+        results["scan_indexed_ms"] = timed(scan, engine.Library(index_path, os.path.join(work, "playlists2.db")), [root])
+        results["restore_ms"] = timed(restore, engine.Library(index_path, os.path.join(work, "playlists3.db")), library.session())
+        results["memory_bytes_per_track"] = track_bytes(index_path, [root], size)
+
+        for order, fields in engine.SORT_ORDERS.items():
+            if fields:
+                library.sort_cache = {}
+                results[f"sort_{order}_ms"] = timed(library.sort, order)
+        results["search_ms"] = timed(library.search, "love nig")
+        library.search("")
+
+        rng = random.Random(2)
+        paths = list(library.tracks)
+        library.playlists.create("Benchmark")
+        library.playlists.append("Benchmark", rng.sample(paths, min(len(paths), 5000)))
+        library.sort("Name")
+        results["playlist_open_ms"] = timed(library.select_playlist, "Benchmark")
+        results["playlist_all_songs_ms"] = timed(library.select_playlist, engine.ALL_SONGS)
+        results["playlist_append_ms"] = timed(library.playlists.append, "Benchmark", [rng.choice(paths)])
+        m3u_path = os.path.join(work, "benchmark.m3u8")
+        results["playlist_export_m3u_ms"] = timed(library.export_m3u, m3u_path, "Benchmark")
+        results["playlist_import_m3u_ms"] = timed(library.import_m3u, m3u_path, "Imported")
+
+        covers = list({song.art_key: song for song in library.tracks.values() if song.art_key}.values())[:50]
+        art_dir = os.path.join(work, "art_cache")
+        cold, warm = engine.ArtCache(art_dir), engine.ArtCache(art_dir)
+        results["art_cold_ms"] = median([timed(cold.photo, song) for song in covers])
+        results["art_disk_ms"] = median([timed(warm.photo, song) for song in covers])
+        results["art_memory_ms"] = median([timed(warm.photo, song) for song in covers])
+    peak = peak_rss_mb()
+    if peak is not None:
+        results["peak_rss_mb"] = peak
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dir", default=os.path.join(tempfile.gettempdir(), "nacsa_benchmark"), help="where generated libraries are kept")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against --baseline (default 0.25)")
+    args = parser.parse_args()
+
+    all_results = {}
+    for size in args.sizes:
+        root = library_dir(args.dir, size)
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            results = all_results[str(size)] = pool.submit(measure, root, size).result()
+        print(f"\n{size} tracks")
+        for metric, value in results.items():
+            print(f"  {metric:<36}{value:>12.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = [(size, metric, before, all_results[size][metric])
+                       for size, metrics in baseline.items() if size in all_results
+                       for metric, before in metrics.items()
+                       if metric in all_results[size] and all_results[size][metric] > before * (1 + args.tolerance) + 1]
+        for size, metric, before, after in regressions:
+            print(f"REGRESSION {size} tracks, {metric}: {before:.2f} -> {after:.2f}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1772 @@
+"""Library, playlist and playback engine of NACSA Tunes, usable without Tk.
+
+Nothing here needs a display. Playback goes through pygame.mixer, which also runs on SDL's dummy audio driver
+(SDL_AUDIODRIVER=dummy) for headless use such as benchmark.py. pygame, mutagen and PIL are imported where they are
+first needed rather than here, so loading this module stays cheap enough for the startup path.
+"""
+import os
+import sys
+import random
+import json
+import io
+import sqlite3
+import threading
+import queue
+import time
+import hashlib
+import math
+import unicodedata
+import re
+import struct
+import functools
+import codecs
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from operator import attrgetter, mul
+from multiprocessing import get_context
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+LIBRARY_INDEX_PATH = "library_index.db"
+PLAYLISTS_DB_PATH = "playlists.db"
+LEGACY_PLAYLISTS_PATH = "playlists.json"
+SESSION_PATH = "session.json"
+ART_SIZE = (300, 300)
+ART_CACHE_DIR = "art_cache"
+ART_MEMORY_CACHE_SIZE = 64
+ALL_SONGS = "All Songs"
+LOUDNESS_TARGET_DB = -18.0
+SILENCE_DB = -60.0
+MAX_GAIN_DB = 12.0
+ANALYSIS_RATE = 22050
+ANALYSIS_HOLD_S = 5
+ANALYSIS_LONG_SECONDS = 900
+ANALYSIS_MAX_SECONDS = 3600
+SORT_ORDERS = {
+    "Playlist Order": (),
+    "Name": ('sort_name',),
+    "Title": ('sort_title', 'artist'),
+    "Artist": ('artist', 'sort_title'),
+    "Album": ('album', 'disc_no', 'track_no'),
+    "Artist › Album › Track": ('artist', 'album', 'disc_no', 'track_no'),
+}
+
+
+class PerfStats:
+    """Timings and counters of the hot paths, cheap enough to leave on.
+
+    Every operation keeps its call count, total and maximum, plus its latest SAMPLES durations for percentiles.
+    A main-thread operation that runs longer than slow_ms holds up the Tk event loop and is logged as it happens.
+    """
+    SAMPLES = 4096
+
+    def __init__(self, slow_ms=50):
+        self.slow_ms = slow_ms
+        self.operations = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, ms, blocking=True):
+        """Adds one duration; blocking=False marks a span that includes waiting, such as time since launch, so it is never logged as slow."""
+        with self.lock:
+            op = self.operations.get(name)
+            if op is None:
+                op = self.operations[name] = [0, 0.0, 0.0, deque(maxlen=self.SAMPLES)]
+            op[0] += 1
+            op[1] += ms
+            op[2] = max(op[2], ms)
+            op[3].append(ms)
+        if blocking and ms > self.slow_ms and threading.current_thread() is threading.main_thread():
+            print(f"[perf] {name} blocked the main thread for {ms:.0f} ms")
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - started) * 1000)
+
+    def timed(self, name=None):
+        """Decorator that records every call of the function under name, or under the function's own name."""
+        def decorate(fn):
+            op = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(op):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def summary(self):
+        with self.lock:
+            operations = {name: (count, total, peak, sorted(samples)) for name, (count, total, peak, samples) in self.operations.items()}
+            counters = dict(self.counters)
+        return {
+            "operations": {name: {"count": count, "total_ms": round(total, 3),
+                                  "p50_ms": round(samples[len(samples) // 2], 3),
+                                  "p95_ms": round(samples[min(len(samples) - 1, len(samples) * 95 // 100)], 3),
+                                  "max_ms": round(peak, 3)}
+                           for name, (count, total, peak, samples) in sorted(operations.items())},
+            "counters": dict(sorted(counters.items())),
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+perf = PerfStats()
+
+
+class StringTable:
+    """Dictionary encoding of a string column that repeats across tracks, such as the artist.
+
+    Every distinct value is stored once and tracks hold its integer id. Ids are handed out on the scan threads,
+    hence the lock; a value is in values before its id is published, so lookups need no lock.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.keys = []
+        self.ids = {}
+        self.lock = threading.Lock()
+        self.sort_ranks = array("I")
+
+    def id(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            with self.lock:
+                value_id = self.ids.get(value)
+                if value_id is None:
+                    value_id = len(self.values)
+                    self.keys.append(collation_key(value))
+                    self.values.append(value)
+                    self.ids[value] = value_id
+        return value_id
+
+    def ranks(self):
+        """Returns the collation rank of every id, equal for values that collate equal; recomputed as the table grows."""
+        count = len(self.values)
+        if len(self.sort_ranks) != count:
+            keys = self.keys[:count]
+            order = sorted(range(count), key=keys.__getitem__)
+            ranks = array("I", bytes(4 * count))
+            for n, value_id in enumerate(order):
+                ranks[value_id] = ranks[order[n - 1]] if n and keys[value_id] == keys[order[n - 1]] else n
+            self.sort_ranks = ranks
+        return self.sort_ranks
+
+
+ARTISTS = StringTable()
+ALBUMS = StringTable()
+
+
+class Track:
+    """One library song.
+
+    Artist and album are ids into ARTISTS and ALBUMS and art keys are interned, so those strings exist once per
+    library rather than once per track; with __slots__ a track is a fixed handful of references instead of a dict.
+    """
+    __slots__ = ('path', 'title', 'artist_id', 'album_id', 'length', 'bitrate', 'art_key', 'art_offset', 'art_size',
+                 'track_no', 'disc_no', 'seek_table', 'sort_name', 'sort_title')
+
+    def __init__(self, path, title=None, artist="Unknown Artist", album="Unknown Album", length=0, bitrate=0,
+                 art_key=None, art_offset=None, art_size=0, track_no=0, disc_no=0, seek_table=None):
+        self.path = path
+        self.title = self.filename if title is None else title
+        self.artist_id = ARTISTS.id(artist)
+        self.album_id = ALBUMS.id(album)
+        self.length, self.bitrate = length, bitrate
+        self.art_key = sys.intern(art_key) if art_key else None
+        self.art_offset, self.art_size = art_offset, art_size
+        self.track_no, self.disc_no = track_no, disc_no
+        self.seek_table = seek_table
+        self.sort_name = collation_key(self.filename)
+        self.sort_title = self.sort_name if self.title == self.filename else collation_key(self.title)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def artist(self):
+        return ARTISTS.values[self.artist_id]
+
+    @property
+    def album(self):
+        return ALBUMS.values[self.album_id]
+
+    def seek_byte(self, seconds):
+        """Returns the file offset playback of a VBR track should resume from to land on seconds, or None."""
+        if not self.seek_table or self.length <= 0:
+            return None
+        start, size = struct.unpack_from(">II", self.seek_table)
+        toc = self.seek_table[8:]
+        percent = min(max(seconds / self.length * 100, 0.0), 99.999)
+        index = int(percent)
+        following = toc[index + 1] if index < 99 else 256
+        return start + int((toc[index] + (following - toc[index]) * (percent - index)) / 256 * size)
+
+
+# Sort fields whose values come from a StringTable, ordered by rank instead of by string.
+RANKED_FIELDS = {'artist': ('artist_id', ARTISTS), 'album': ('album_id', ALBUMS)}
+
+
+def sort_column(songs, field):
+    """Returns the values songs are sorted by for one SORT_ORDERS field."""
+    if field in RANKED_FIELDS:
+        id_field, table = RANKED_FIELDS[field]
+        return list(map(table.ranks().__getitem__, map(attrgetter(id_field), songs)))
+    return list(map(attrgetter(field), songs))
+
+
+def _leading_number(text):
+    match = _DIGITS.match(str(text).strip())
+    return int(match.group()) if match else 0
+
+
+def probe_track(path):
+    """Reads tags, duration, bitrate and the location of the embedded art of one file in a single open."""
+    from mutagen.mp3 import MP3
+    from mutagen.id3 import ID3
+    fields = {}
+    try:
+        with open(path, "rb") as f:
+            perf.count("file_reads.probe")
+            try:
+                audio = MP3(f)
+                tags = audio.tags
+                fields['length'], fields['bitrate'] = audio.info.length, audio.info.bitrate
+            except Exception:
+                f.seek(0)
+                tags = ID3(f)
+            if tags:
+                if 'TIT2' in tags:
+                    fields['title'] = str(tags['TIT2'][0])
+                fields['artist'] = str(tags.get('TPE1', ['Unknown Artist'])[0])
+                fields['album'] = str(tags.get('TALB', ['Unknown Album'])[0])
+                fields['track_no'] = _leading_number(tags.get('TRCK', ['0'])[0])
+                fields['disc_no'] = _leading_number(tags.get('TPOS', ['0'])[0])
+                image_data = next((frame.data for key, frame in tags.items() if key.startswith("APIC")), None)
+                if image_data:
+                    fields['art_key'] = hashlib.sha1(image_data).hexdigest()
+                    fields['art_size'] = len(image_data)
+                    fields['art_offset'] = _find_art_offset(f, len(image_data))
+            fields['seek_table'] = _read_seek_table(f)
+    except Exception:
+        pass
+    return Track(path, **fields)
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _find_art_offset(f, data_size):
+    """Walks the ID3v2 frame headers for the first APIC frame and returns the file offset of its image data.
+
+    Returns None when the image is not stored verbatim (ID3v2.2, unsynchronised, compressed or encrypted frames);
+    those tracks fall back to a full tag parse when their art is needed.
+    """
+    f.seek(0)
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b"ID3" or header[3] not in (3, 4) or header[5] & 0x80:
+        return None
+    major, end, pos = header[3], 10 + _syncsafe(header[6:10]), 10
+    if header[5] & 0x40:
+        f.seek(pos)
+        size = f.read(4)
+        pos += _syncsafe(size) if major == 4 else 4 + int.from_bytes(size, "big")
+    while pos + 10 <= end:
+        f.seek(pos)
+        frame = f.read(10)
+        if len(frame) < 10 or frame[0] == 0:
+            return None
+        size = _syncsafe(frame[4:8]) if major == 4 else int.from_bytes(frame[4:8], "big")
+        if frame[:4] == b"APIC":
+            if frame[9] & (0x0E if major == 4 else 0xC0):
+                return None
+            return pos + 10 + size - data_size
+        pos += 10 + size
+    return None
+
+
+def _read_seek_table(f):
+    """Reads the Xing or VBRI table of contents of a VBR file, which maps time to byte offsets.
+
+    Returns the offset and size of the audio followed by the 100 Xing-style TOC entries (byte position of each
+    percent of the duration, in 256ths of the size), or None for CBR files and files without a table.
+    """
+    f.seek(0)
+    header = f.read(10)
+    start = 0
+    if len(header) == 10 and header[:3] == b"ID3":
+        start = 10 + _syncsafe(header[6:10]) + (10 if header[5] & 0x10 else 0)
+    f.seek(start)
+    data = f.read(4096)
+    sync = next((i for i in range(len(data) - 3) if data[i] == 0xFF and data[i + 1] & 0xE0 == 0xE0), None)
+    if sync is None:
+        return None
+    start += sync
+    frame = data[sync:]
+    version, layer, mono = (frame[1] >> 3) & 3, (frame[1] >> 1) & 3, (frame[3] >> 6) == 3
+    if layer != 1:  # Layer III
+        return None
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    xing = frame[4 + side_info:]
+    if xing[:4] == b"Xing" and len(xing) >= 8:
+        flags, pos = struct.unpack_from(">I", xing, 4)[0], 8
+        if not flags & 4:
+            return None
+        pos += 4 if flags & 1 else 0
+        if flags & 2:
+            size = struct.unpack_from(">I", xing, pos)[0]
+            pos += 4
+        else:
+            size = os.fstat(f.fileno()).st_size - start
+        toc = xing[pos:pos + 100]
+        return struct.pack(">II", start, size) + toc if len(toc) == 100 else None
+    vbri = frame[36:]
+    if vbri[:4] == b"VBRI" and len(vbri) >= 26:
+        size, frames, entries, scale, entry_size, frames_per_entry = struct.unpack_from(">IIHHHH", vbri, 10)
+        if not (size and frames and entries and entry_size in (1, 2, 3, 4)):
+            return None
+        table = vbri[26:26 + entries * entry_size]
+        offsets = [0]
+        for i in range(0, len(table) - entry_size + 1, entry_size):
+            offsets.append(offsets[-1] + int.from_bytes(table[i:i + entry_size], "big") * scale)
+        toc = bytearray()
+        for percent in range(100):
+            entry = percent * frames / 100 / frames_per_entry
+            index = min(int(entry), len(offsets) - 2)
+            byte = offsets[index] + (offsets[index + 1] - offsets[index]) * (entry - index)
+            toc.append(min(255, int(byte / size * 256)))
+        return struct.pack(">II", start, size) + bytes(toc)
+    return None
+
+
+def _under(root):
+    # Half-open range that matches root and every path below it, so prefix lookups can use the index.
+    return root, root.rstrip(os.sep) + os.sep, root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+
+
+class LibraryIndex:
+    """SQLite cache of parsed tags keyed by path, validated by file size and mtime."""
+    SCHEMA_VERSION = 5
+    SONG_FIELDS = ('title', 'artist', 'album', 'length', 'bitrate', 'art_key', 'art_offset', 'art_size', 'track_no', 'disc_no',
+                   'seek_table')
+
+    def __init__(self, db_path=LIBRARY_INDEX_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            # The index is only a cache, so an old layout is simply rebuilt on the next scan.
+            self.conn.executescript(f"""
+                DROP TABLE IF EXISTS tracks;
+                DROP TABLE IF EXISTS dirs;
+                CREATE TABLE tracks (path TEXT PRIMARY KEY, dir TEXT NOT NULL, size INTEGER NOT NULL, mtime REAL NOT NULL,
+                                     filename TEXT, title TEXT, artist TEXT, album TEXT, length REAL, bitrate INTEGER,
+                                     art_key TEXT, art_offset INTEGER, art_size INTEGER, track_no INTEGER, disc_no INTEGER,
+                                     seek_table BLOB);
+                CREATE INDEX tracks_dir ON tracks (dir);
+                CREATE TABLE dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL NOT NULL);
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+            """)
+        # Loudness results are slow to recompute, so unlike the tables above they survive layout changes.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS loudness (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, "
+                          "level REAL, seconds REAL)")
+
+    def load(self, roots):
+        """Returns a LibraryState with every indexed directory and file below roots, without touching the disk."""
+        state = LibraryState()
+        for root in roots:
+            for path, parent, mtime in self.conn.execute(
+                    "SELECT path, parent, mtime FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", _under(root)):
+                state.dirs[path] = (mtime, [])
+            for path, dir, size, mtime, *fields in self.conn.execute(
+                    f"SELECT path, dir, size, mtime, {', '.join(self.SONG_FIELDS)} FROM tracks WHERE dir = ? OR (dir >= ? AND dir < ?)", _under(root)):
+                state.files.setdefault(dir, {})[path] = (size, mtime, Track(path, *fields))
+        for path in state.dirs:
+            parent = state.dirs.get(os.path.dirname(path))
+            if parent is not None and path != os.path.dirname(path):
+                parent[1].append(path)
+        return state
+
+    def store(self, entries):
+        with self.conn:
+            self.conn.executemany(f"INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?{', ?' * len(self.SONG_FIELDS)})",
+                                  [(song.path, os.path.dirname(song.path), size, mtime, song.filename, *map(song.__getattribute__, self.SONG_FIELDS))
+                                   for size, mtime, song in entries])
+
+    def remove(self, paths):
+        with self.conn:
+            self.conn.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in paths])
+            self.conn.executemany("DELETE FROM loudness WHERE path = ?", [(path,) for path in paths])
+
+    def load_loudness(self):
+        """Returns {path: (size, mtime, level, seconds)} of every analysed file; level is None if it could not be decoded."""
+        return {path: row for path, *row in self.conn.execute("SELECT path, size, mtime, level, seconds FROM loudness")}
+
+    def store_loudness(self, rows):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO loudness VALUES (?, ?, ?, ?, ?)", rows)
+
+    def store_dirs(self, dirs, removed):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                                  [(path, os.path.dirname(path), mtime) for path, mtime in dirs])
+            self.conn.executemany("DELETE FROM dirs WHERE path = ?", [(path,) for path in removed])
+
+
+class PlaylistStore:
+    """Playlists kept in SQLite, one small transaction per edit, so adding a song never rewrites the other entries.
+
+    Items are (playlist_id, position, track). Tracks are paths, except for bare filenames imported from version 1
+    playlists.json files, which stay marked unresolved until resolve_filenames() finds them in the library.
+    """
+
+    def __init__(self, db_path=PLAYLISTS_DB_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS playlists (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS playlist_items (
+                playlist_id INTEGER NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+                position INTEGER NOT NULL, track TEXT NOT NULL, resolved INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (playlist_id, position)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS playlist_items_track ON playlist_items (playlist_id, track);
+            CREATE INDEX IF NOT EXISTS playlist_items_unresolved ON playlist_items (playlist_id) WHERE resolved = 0;
+        """)
+
+    def import_json(self, json_path):
+        """Copies the playlists of an old playlists.json in once; later calls do nothing."""
+        if self.conn.execute("PRAGMA user_version").fetchone()[0]:
+            return
+        try:
+            with open(json_path, "r") as f: data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError): data = {}
+        # Version 2 files are {"version": 2, "playlists": {name: [path, ...]}}; version 1 files are {name: [filename, ...]}.
+        playlists = data.get("playlists", {}) if isinstance(data.get("version"), int) else data
+        with self.conn:
+            for name, entries in playlists.items():
+                self.conn.execute("INSERT OR IGNORE INTO playlists (name) VALUES (?)", (name,))
+                self._write(self._id(name), entries)
+            self.conn.execute("PRAGMA user_version = 1")
+
+    def names(self):
+        return [name for (name,) in self.conn.execute("SELECT name FROM playlists ORDER BY id")]
+
+    def tracks(self, name):
+        return [track for (track,) in self.conn.execute(
+            "SELECT track FROM playlist_items JOIN playlists ON id = playlist_id WHERE name = ? ORDER BY position", (name,))]
+
+    def create(self, name):
+        """Adds an empty playlist and returns False if the name is taken."""
+        with self.conn:
+            return self.conn.execute("INSERT OR IGNORE INTO playlists (name) VALUES (?)", (name,)).rowcount == 1
+
+    def delete(self, name):
+        with self.conn:
+            self.conn.execute("DELETE FROM playlists WHERE name = ?", (name,))
+
+    def append(self, name, tracks):
+        """Adds the tracks that are not in the playlist yet to its end and returns them."""
+        with self.conn:
+            playlist_id = self._id(name)
+            (end,) = self.conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM playlist_items WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            added = [track for track in dict.fromkeys(tracks) if self.conn.execute(
+                "SELECT 1 FROM playlist_items WHERE playlist_id = ? AND track = ?", (playlist_id, track)).fetchone() is None]
+            self.conn.executemany("INSERT INTO playlist_items (playlist_id, position, track) VALUES (?, ?, ?)",
+                                  [(playlist_id, end + i, track) for i, track in enumerate(added)])
+        return added
+
+    def remove(self, name, tracks):
+        """Takes tracks out of the playlist and closes the gaps, in one transaction; returns how many were removed."""
+        doomed = set(tracks)
+        with self.conn:
+            playlist_id = self._id(name)
+            entries = self._entries(playlist_id)
+            kept = [track for track in entries if track not in doomed]
+            if len(kept) != len(entries):
+                self._write(playlist_id, kept)
+        return len(entries) - len(kept)
+
+    def move(self, name, tracks, offset):
+        """Moves tracks offset places towards the end (or the start, if negative) past the other entries, in one transaction.
+
+        Tracks that reach an end or another moved track stop there, so a selection keeps its order.
+        """
+        moving = set(tracks)
+        with self.conn:
+            playlist_id = self._id(name)
+            entries = self._entries(playlist_id)
+            step = 1 if offset > 0 else -1
+            order = range(len(entries) - 2, -1, -1) if step > 0 else range(1, len(entries))
+            for _ in range(abs(offset)):
+                for i in order:
+                    if entries[i] in moving and entries[i + step] not in moving:
+                        entries[i], entries[i + step] = entries[i + step], entries[i]
+            self._write(playlist_id, entries)
+
+    def has_unresolved(self):
+        return self.conn.execute("SELECT 1 FROM playlist_items WHERE resolved = 0 LIMIT 1").fetchone() is not None
+
+    def resolve_filenames(self, by_filename):
+        """Replaces each unresolved filename with every path by_filename lists for it; unknown names are kept."""
+        with self.conn:
+            for (playlist_id,) in self.conn.execute("SELECT DISTINCT playlist_id FROM playlist_items WHERE resolved = 0").fetchall():
+                entries, seen = [], set()
+                for track, resolved in self.conn.execute(
+                        "SELECT track, resolved FROM playlist_items WHERE playlist_id = ? ORDER BY position", (playlist_id,)).fetchall():
+                    # A filename used to match every song of that name, so it expands to all of them.
+                    for path in (by_filename.get(track) if not resolved else None) or [track]:
+                        if path not in seen:
+                            seen.add(path)
+                            entries.append(path)
+                self._write(playlist_id, entries)
+
+    def _id(self, name):
+        return self.conn.execute("SELECT id FROM playlists WHERE name = ?", (name,)).fetchone()[0]
+
+    def _entries(self, playlist_id):
+        return [track for (track,) in self.conn.execute(
+            "SELECT track FROM playlist_items WHERE playlist_id = ? ORDER BY position", (playlist_id,))]
+
+    def _write(self, playlist_id, entries):
+        self.conn.execute("DELETE FROM playlist_items WHERE playlist_id = ?", (playlist_id,))
+        self.conn.executemany("INSERT INTO playlist_items VALUES (?, ?, ?, ?)",
+                              [(playlist_id, i, entry, os.path.isabs(entry)) for i, entry in enumerate(entries)])
+
+
+def _m3u_encoding(path):
+    # M3U8 is UTF-8 by definition; plain M3U files are whatever their writer used, so they are checked chunk by chunk.
+    if path.lower().endswith(".m3u8"):
+        return "utf-8-sig"
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return "latin-1"
+    return "utf-8-sig"
+
+
+def read_m3u(path):
+    """Yields (line_no, entry) for every track line of an M3U or M3U8 playlist, reading one line at a time.
+
+    Relative entries are resolved against the playlist's folder and file:// URLs become paths; other URLs
+    are passed through as they are.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding=_m3u_encoding(path), errors="replace") as f:
+        for line_no, line in enumerate(f, 1):
+            entry = line.strip()
+            if not entry or entry.startswith("#"):
+                continue
+            if entry.lower().startswith("file://"):
+                entry = url2pathname(urlparse(entry).path)
+            elif "://" in entry:
+                yield line_no, entry
+                continue
+            yield line_no, os.path.normpath(os.path.join(base, entry))
+
+
+def write_m3u(path, entries):
+    """Writes (track, song) pairs as an extended M3U playlist in UTF-8; song may be None for tracks not in the library."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#EXTM3U\n")
+        for track, song in entries:
+            if song is not None:
+                f.write(f"#EXTINF:{round(song.length) if song.length else -1},{song.artist} - {song.title}\n")
+            f.write(f"{track}\n")
+
+
+class LibraryState:
+    """Snapshot of a scanned library: dirs maps path -> (mtime, subdirs), files maps dir -> {path: (size, mtime, song)}."""
+
+    def __init__(self):
+        self.dirs = {}
+        self.files = {}
+
+    def songs(self):
+        return [entry[2] for files in self.files.values() for entry in files.values()]
+
+
+class LibraryScan:
+    """Walks the library roots on a background thread and parses new or changed files on a worker pool.
+
+    Directories whose mtime matches the previous state are not listed again: their files and subdirectories are
+    taken from that state. Editing a file's tags in place leaves the directory mtime alone, so with check_files
+    set their files are still stat'ed; without it an unchanged tree costs one stat per directory. A root or
+    directory that cannot be read, such as an unmounted share, keeps what the previous state knew under it
+    instead of being taken as deleted. Each result put on self.results is (song, entry, replaced, terms), where
+    entry is None for unchanged files (only reported when report_unchanged is set), replaced tells whether an
+    older version of the file was known and terms are the song's search_terms(). A final None marks the end of
+    the scan, after which self.state and self.removed are complete. With from_index set, the songs are reported
+    straight from the library index and nothing on disk is looked at; a later rescan finds what changed since.
+    """
+
+    def __init__(self, roots, previous=None, report_unchanged=True, workers=None, index_path=LIBRARY_INDEX_PATH, from_index=False,
+                 check_files=True):
+        self.roots = roots
+        self.previous = previous
+        self.index_path = index_path
+        self.from_index = from_index
+        self.report_unchanged = report_unchanged
+        self.check_files = check_files
+        self.workers = workers or min(8, (os.cpu_count() or 1) * 2)
+        self.state = LibraryState()
+        self.changed_dirs = []
+        self.removed = []
+        self.removed_dirs = []
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.total = self.done = 0
+        self.started = time.perf_counter()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def throughput(self):
+        elapsed = time.perf_counter() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def _run(self):
+        if self.previous is None:
+            # SQLite connections belong to the thread that opened them, so the scan thread reads the index through its own.
+            self.previous = LibraryIndex(self.index_path).load(self.roots)
+        if self.from_index:
+            self.state = self.previous
+            for files in self.state.files.values():
+                for size, mtime, song in files.values():
+                    if self.cancelled.is_set():
+                        return
+                    self.results.put((song, None, False, search_terms(song)))
+            perf.record("restore", (time.perf_counter() - self.started) * 1000)
+            self.results.put(None)
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            stack = []
+            for root in reversed(self.roots):
+                try:
+                    stack.append((root, os.stat(root).st_mtime))
+                except OSError:
+                    self._carry(root)
+            while stack:
+                if self.cancelled.is_set():
+                    pool.shutdown(cancel_futures=True)
+                    return
+                dirpath, dir_mtime = stack.pop()
+                if dirpath in self.state.dirs:
+                    continue
+                stack.extend(reversed(self._visit(pool, dirpath, dir_mtime)))
+        if self.cancelled.is_set():
+            return
+        old_dirs, old_files = self.previous.dirs, self.previous.files
+        self.removed_dirs = [path for path in old_dirs if path not in self.state.dirs]
+        self.removed = [path for dirpath, files in old_files.items()
+                        for path in files if path not in self.state.files.get(dirpath, ())]
+        perf.record("scan" if self.report_unchanged else "rescan", (time.perf_counter() - self.started) * 1000)
+        self.results.put(None)
+
+    def _visit(self, pool, dirpath, dir_mtime):
+        """Collects the files of one directory and returns its subdirectories as (path, mtime) pairs."""
+        known = self.previous.dirs.get(dirpath)
+        old_files = self.previous.files.get(dirpath, {})
+        files = self.state.files[dirpath] = {}
+        if known and known[0] == dir_mtime:
+            self.state.dirs[dirpath] = known
+            for path, old in old_files.items():
+                # Deleting a file would have changed the directory mtime, so one that cannot be stat'ed is kept.
+                try:
+                    st = os.stat(path) if self.check_files else None
+                except OSError:
+                    st = None
+                self._check(pool, files, path, st, old)
+            subdirs = []
+            for path in known[1]:
+                try:
+                    subdirs.append((path, os.stat(path).st_mtime))
+                except OSError:
+                    self._carry(path)
+            return subdirs
+        try:
+            entries = os.scandir(dirpath)
+        except OSError:
+            del self.state.files[dirpath]
+            self._carry(dirpath)
+            return []
+        subdirs = []
+        try:
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append((entry.path, entry.stat(follow_symlinks=False).st_mtime))
+                        elif entry.name.lower().endswith(".mp3") and entry.is_file():
+                            self._check(pool, files, entry.path, entry.stat(), old_files.get(entry.path))
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        self.state.dirs[dirpath] = (dir_mtime, [path for path, mtime in subdirs])
+        self.changed_dirs.append((dirpath, dir_mtime))
+        return subdirs
+
+    def _carry(self, dirpath):
+        """Takes over what the previous state knew under a directory that cannot be read right now."""
+        stack = [dirpath]
+        while stack:
+            path = stack.pop()
+            known = self.previous.dirs.get(path)
+            if known is None or path in self.state.dirs:
+                continue
+            self.state.dirs[path] = known
+            files = self.state.files[path] = dict(self.previous.files.get(path, {}))
+            if self.report_unchanged:
+                for size, mtime, song in files.values():
+                    self.results.put((song, None, False, search_terms(song)))
+            stack.extend(known[1])
+
+    def _check(self, pool, files, path, st, old):
+        """Keeps the known entry of a file whose size and mtime are unchanged, or that was not stat'ed (st is None),
+        and queues any other file for a probe."""
+        if old and (st is None or old[0] == st.st_size and old[1] == st.st_mtime):
+            files[path] = old
+            if self.report_unchanged:
+                self.results.put((old[2], None, False, search_terms(old[2])))
+        else:
+            self.total += 1
+            pool.submit(self._probe, files, path, st.st_size, st.st_mtime, old is not None)
+
+    def _probe(self, files, path, size, mtime, replaced):
+        if self.cancelled.is_set():
+            return
+        entry = files[path] = (size, mtime, probe_track(path))
+        self.results.put((entry[2], entry, replaced, search_terms(entry[2])))
+
+
+def _init_analysis_worker():
+    # Decoding needs an open mixer, but the workers must never claim the sound card or compete with the player.
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+    if hasattr(os, "nice"):
+        os.nice(10)
+    import pygame
+    pygame.mixer.init(frequency=ANALYSIS_RATE, size=-16, channels=1)
+
+
+def measure_loudness(path):
+    """Decodes path and returns (level, seconds): the loudness of its loud passages in dBFS and its duration.
+
+    The level is the 95th percentile of the RMS of 50 ms blocks, as in ReplayGain but without its
+    equal-loudness filter. Runs in the worker processes, whose mixer _init_analysis_worker opened. The
+    samples are read in place from the decoded sound, one block at a time, so the file is held in memory once.
+    """
+    import pygame
+    rate, size, channels = pygame.mixer.get_init()
+    samples = memoryview(pygame.mixer.Sound(path)).cast("B").cast("h")
+    block = rate * channels // 20
+    energies = sorted(sum(map(mul, chunk, chunk)) for chunk in
+                      (samples[start:start + block] for start in range(0, len(samples) - block + 1, block)))
+    seconds = len(samples) / (rate * channels)
+    if not energies:
+        return None, seconds
+    mean_square = max(energies[len(energies) * 95 // 100] / block, 1)
+    return 10 * math.log10(mean_square / 32768 ** 2), seconds
+
+
+class LoudnessAnalyzer:
+    """Track and album gain, measured on a process pool in the background and kept in the library index.
+
+    analyze() takes the LibraryState of a finished scan; files whose path, size and mtime match a stored
+    result are never decoded again. A worker holds a whole decoded file in memory, so files longer than
+    ANALYSIS_LONG_SECONDS are decoded one at a time and those longer than ANALYSIS_MAX_SECONDS not at all. The
+    tracks of one album in one folder share an album level, the duration-weighted energy average of theirs.
+    Files quieter than SILENCE_DB count as unmeasured, and gains are kept within MAX_GAIN_DB either way.
+    hold() keeps new decodes from starting for a while, so starting playback and scanning get the CPU and disk
+    first.
+    """
+
+    def __init__(self, index_path=LIBRARY_INDEX_PATH, workers=None):
+        self.index_path = index_path
+        self.workers = workers or os.cpu_count() or 1
+        self.levels = {}
+        self.album_of = {}
+        self.albums = {}
+        self.lock = threading.Lock()
+        self.resume_at = 0.0
+        self.cancelled = threading.Event()
+
+    def analyze(self, state):
+        """Measures every file of state that has no stored result, after taking in the stored ones."""
+        self.cancel()
+        self.cancelled = threading.Event()
+        entries = [entry for files in state.files.values() for entry in files.values()]
+        threading.Thread(target=self._run, args=(entries, self.cancelled), daemon=True).start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def hold(self, seconds=ANALYSIS_HOLD_S):
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def gain(self, song, mode):
+        """Returns the gain in dB, within MAX_GAIN_DB, that brings song to LOUDNESS_TARGET_DB in mode "track" or "album"; 0 if not measured."""
+        if mode not in ("track", "album"):
+            return 0.0
+        with self.lock:
+            level = self.levels.get(song.path)
+            album = self.albums.get(self.album_of.get(song.path))
+        if mode == "album" and album:
+            level = 10 * math.log10(album[0] / album[1])
+        return 0.0 if level is None else max(-MAX_GAIN_DB, min(MAX_GAIN_DB, LOUDNESS_TARGET_DB - level))
+
+    def _add(self, tables, path, album_key, level, seconds):
+        if level is None or level < SILENCE_DB or seconds <= 0:
+            return
+        levels, album_of, albums = tables
+        levels[path] = level
+        album_of[path] = album_key
+        album = albums.setdefault(album_key, [0.0, 0.0])
+        album[0] += seconds * 10 ** (level / 10)
+        album[1] += seconds
+
+    def _run(self, entries, cancelled):
+        # The thread reads and writes the index through its own connection, like the scan thread.
+        index = LibraryIndex(self.index_path)
+        stored = index.load_loudness()
+        # Each run fills its own tables, so a run that an analyze() cancelled can't add to the next one's sums.
+        tables = ({}, {}, {})
+        todo, long_todo = deque(), deque()
+        for size, mtime, song in entries:
+            if cancelled.is_set():
+                return
+            album_key = (os.path.dirname(song.path), song.album_id)
+            row = stored.get(song.path)
+            if row and row[0] == size and row[1] == mtime:
+                self._add(tables, song.path, album_key, row[2], row[3])
+            elif (song.length or 0) <= ANALYSIS_MAX_SECONDS:
+                (long_todo if (song.length or 0) > ANALYSIS_LONG_SECONDS else todo).append((song.path, size, mtime, album_key))
+        with self.lock:
+            if cancelled.is_set():
+                return
+            self.levels, self.album_of, self.albums = tables
+        if not (todo or long_todo):
+            return
+        started = time.perf_counter()
+        running = {}
+        long_running = None
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"),
+                                 initializer=_init_analysis_worker) as pool:
+            while (todo or long_todo or running) and not cancelled.is_set():
+                while len(running) < self.workers and time.monotonic() >= self.resume_at:
+                    source = todo or (long_todo if long_running is None else None)
+                    if not source:
+                        break
+                    try:
+                        future = pool.submit(measure_loudness, source[0][0])
+                    except RuntimeError:  # a broken pool, or the interpreter is exiting
+                        cancelled.set()
+                        break
+                    running[future] = source.popleft()
+                    if source is long_todo:
+                        long_running = future
+                if not running:
+                    time.sleep(0.1)
+                    continue
+                finished, _ = wait(running, timeout=0.1, return_when=FIRST_COMPLETED)
+                rows = []
+                for future in finished:
+                    path, size, mtime, album_key = running.pop(future)
+                    if future is long_running:
+                        long_running = None
+                    try:
+                        level, seconds = future.result()
+                    except BrokenProcessPool:
+                        cancelled.set()  # a crashed worker takes the pool down; the rest waits for the next analyze()
+                        continue
+                    except Exception:
+                        level, seconds = None, 0.0  # not retried until the file changes
+                    rows.append((path, size, mtime, level, seconds))
+                    with self.lock:
+                        if not cancelled.is_set():
+                            self._add(tables, path, album_key, level, seconds)
+                if rows:
+                    index.store_loudness(rows)
+                    perf.count("loudness.analyzed", len(rows))
+            pool.shutdown(cancel_futures=True)
+        perf.record("loudness", (time.perf_counter() - started) * 1000)
+
+
+def read_embedded_art(song):
+    """Reads the image bytes of song's art straight from their recorded offset, or via a tag parse if unknown."""
+    if song.art_offset is not None:
+        perf.count("file_reads.art")
+        with open(song.path, "rb") as f:
+            f.seek(song.art_offset)
+            image_data = f.read(song.art_size)
+        if hashlib.sha1(image_data).hexdigest() == song.art_key:
+            return image_data
+    perf.count("file_reads.art_tag_parse")
+    from mutagen.id3 import ID3
+    audio = ID3(song.path)
+    return next((tag.data for key, tag in audio.items() if key.startswith("APIC")), None)
+
+
+def make_thumbnail(image_data):
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_data))
+    # JPEG scans are decoded straight at a reduced scale close to the target instead of at full resolution.
+    img.draft("RGB", ART_SIZE)
+    return img.convert("RGB").resize(ART_SIZE, Image.Resampling.LANCZOS)
+
+
+class ArtCache:
+    """Album art thumbnails keyed by the hash of the embedded image that the probe recorded as art_key.
+
+    Ready images are kept in a bounded in-memory LRU and resized copies are written to cache_dir, so art
+    shared by a whole album is decoded once. prefetch() prepares the thumbnail of an upcoming track on a
+    background thread; only make_photo, e.g. ImageTk.PhotoImage which needs Tk, runs on the caller's thread.
+    Without make_photo, photo() returns the PIL thumbnail itself.
+    """
+
+    def __init__(self, cache_dir=ART_CACHE_DIR, capacity=ART_MEMORY_CACHE_SIZE, make_photo=None):
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        self.make_photo = make_photo or (lambda thumbnail: thumbnail)
+        self.photos = OrderedDict()
+        self.prefetched = {}
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+
+    def photo(self, song):
+        """Returns the thumbnail photo for a song that has art."""
+        key = song.art_key
+        photo = self.photos.get(key)
+        if photo is not None:
+            self.photos.move_to_end(key)
+            perf.count("art.memory_hits")
+            return photo
+        thumbnail = self.prefetched.pop(key, None) or self._load_thumbnail(song)
+        photo = self.photos[key] = self.make_photo(thumbnail)
+        if len(self.photos) > self.capacity:
+            self.photos.popitem(last=False)
+        return photo
+
+    def prefetch(self, song):
+        key = song.art_key
+        if key is not None and key not in self.photos and key not in self.prefetched:
+            self.prefetcher.submit(self._prefetch, song)
+
+    def _prefetch(self, song):
+        try:
+            self.prefetched[song.art_key] = self._load_thumbnail(song)
+            while len(self.prefetched) > self.capacity:
+                self.prefetched.pop(next(iter(self.prefetched)))
+        except Exception:
+            pass
+
+    def _load_thumbnail(self, song):
+        from PIL import Image
+        cache_path = os.path.join(self.cache_dir, f"{song.art_key}.jpg")
+        try:
+            with Image.open(cache_path) as img:
+                thumbnail = img.convert("RGB")
+            perf.count("file_reads.art_cache")
+            return thumbnail
+        except (OSError, ValueError):
+            pass
+        thumbnail = make_thumbnail(read_embedded_art(song))
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            thumbnail.save(cache_path, "JPEG", quality=90)
+        except OSError:
+            pass
+        return thumbnail
+
+
+_NON_ALNUM = re.compile(r"[\W_]+")
+_DIGITS = re.compile(r"\d+")
+
+
+def normalize_text(text):
+    """Case-folds text, strips accents and reduces punctuation to single spaces."""
+    text = str(text).casefold()
+    if not text.isascii():
+        text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return _NON_ALNUM.sub(" ", text).strip()
+
+
+def collation_key(text):
+    """Sort key that ignores case, accents and punctuation and orders embedded numbers by value."""
+    return _DIGITS.sub(lambda m: m.group().zfill(8), normalize_text(text))
+
+
+def search_terms(song):
+    """Returns the normalized text of a song and the posting keys it is filed under in a SearchIndex."""
+    fields = [normalize_text(getattr(song, key)) for key in ('title', 'artist', 'album')]
+    keys = set()
+    for field in fields:
+        for word in field.split():
+            keys.add(word[:1])
+            keys.add(word[:2])
+            keys.update(word[i:i + 3] for i in range(len(word) - 2))
+    return "\n" + "\n".join(fields), keys
+
+
+class SearchIndex:
+    """Inverted index over the normalized title, artist and album of every library song.
+
+    Terms of three or more characters are matched through their trigram posting lists and confirmed with a
+    substring test; shorter terms match the start of a word through one- and two-character prefix lists.
+    Posting lists are intersected from the shortest up, so a query costs time in proportion to its rarest
+    key rather than to the library size. The scan threads compute search_terms() for new songs, leaving only
+    the list appends to the Tk thread. Removed songs stay as holes until enough pile up to rebuild the lists.
+    """
+
+    def __init__(self):
+        self.songs = []
+        self.paths = []
+        self.texts = []
+        self.ids = {}
+        self.postings = {}
+        self.holes = 0
+
+    def add(self, songs, terms=None):
+        for song, (text, keys) in zip(songs, terms or map(search_terms, songs)):
+            self.remove((song.path,))
+            song_id = self.ids[song.path] = len(self.songs)
+            postings = self.postings
+            for key in keys:
+                posting = postings.get(key)
+                if posting is None:
+                    posting = postings[key] = array("I")
+                posting.append(song_id)
+            self.songs.append(song)
+            self.paths.append(song.path)
+            self.texts.append(text)
+
+    def remove(self, paths):
+        for path in paths:
+            song_id = self.ids.pop(path, None)
+            if song_id is not None:
+                self.songs[song_id] = self.paths[song_id] = None
+                self.texts[song_id] = ""
+                self.holes += 1
+        if self.holes > 1000 and self.holes * 4 > len(self.songs):
+            songs = [song for song in self.songs if song is not None]
+            self.__init__()
+            self.add(songs)
+
+    def search(self, query):
+        """Returns the set of paths matching every term of query, or None when the query is empty."""
+        terms = normalize_text(query).split()
+        if not terms:
+            return None
+        term_keys = {term: [term] if len(term) < 3 else [term[i:i + 3] for i in range(len(term) - 2)] for term in terms}
+        postings = sorted(((key, self.postings.get(key, ())) for keys in term_keys.values() for key in keys), key=lambda item: len(item[1]))
+        candidates = set(postings[0][1])
+        used = {postings[0][0]}
+        for key, posting in postings[1:]:
+            # Once a list dwarfs the candidates it is cheaper to test the candidates' text than to intersect.
+            if not candidates or len(posting) > 8 * len(candidates):
+                break
+            candidates.intersection_update(posting)
+            used.add(key)
+        texts = self.texts
+        for term, keys in term_keys.items():
+            # Trigram hits are only exact for three-letter terms; longer ones could have their trigrams apart.
+            if len(term) >= 3 and (len(term) > 3 or not used.issuperset(keys)):
+                candidates = [i for i in candidates if term in texts[i]]
+            elif len(term) < 3 and not used.issuperset(keys):
+                word_start, field_start = " " + term, "\n" + term
+                candidates = [i for i in candidates if word_start in texts[i] or field_start in texts[i]]
+        matches = set(map(self.paths.__getitem__, candidates))
+        matches.discard(None)
+        return matches
+
+
+class PlayQueue:
+    """The order songs play in, kept apart from the order they are shown in.
+
+    songs is the list on view and current the index of the song playing in it. Unshuffled, songs play in view
+    order and pos is an index into songs. Shuffled, order is a permutation of the paths of every library track,
+    slots maps each path to its place in it and pos is a place in order; songs that are not on view are skipped.
+    The permutation does not depend on the view, so sorts, searches and scans leave it alone and paths are
+    mapped to rows through positions, built once per view when first needed. pos and current differ while a
+    song from up_next plays. up_next holds the paths queued with Play Next / Add to Queue and history the paths
+    that played.
+    """
+    HISTORY_SIZE = 500
+
+    def __init__(self):
+        self.songs = []
+        self.order = self.slots = None
+        self.pos = self.current = -1
+        self.next_round = None
+        self.up_next = deque()
+        self.history = deque(maxlen=self.HISTORY_SIZE)
+        self.positions = None
+
+    def reset(self):
+        shuffled = self.order is not None
+        self.__init__()
+        if shuffled:
+            self.order, self.slots = [], {}
+
+    def index_of(self, path):
+        if self.positions is None:
+            self.positions = {song.path: i for i, song in enumerate(self.songs)}
+        return self.positions.get(path, -1)
+
+    def set_songs(self, songs, current):
+        """Follows a change of the list on view and returns the index of the song current in it, or -1.
+
+        Unshuffled, the place in the order follows the song it was at; shuffled, the order is not touched.
+        """
+        old_songs, old_pos = self.songs, self.pos
+        anchor = old_songs[old_pos].path if self.order is None and 0 <= old_pos < len(old_songs) else None
+        if songs is old_songs and self.positions is not None:
+            # The same list, at most grown at the end while a scan streams in.
+            positions = self.positions
+            for i in range(len(positions), len(songs)):
+                positions[songs[i].path] = i
+        else:
+            self.songs, self.positions = songs, None
+        self.current = self.index_of(current.path) if current is not None else -1
+        if self.order is None:
+            self.pos = self.index_of(anchor) if anchor is not None else self.current
+        return self.current
+
+    def add(self, paths):
+        """Deals tracks new to the library into the shuffled order, each at a random place among those still to come."""
+        if self.order is None:
+            return
+        order, slots, start = self.order, self.slots, self.pos + 1
+        for path in paths:
+            if path in slots:
+                continue
+            order.append(path)
+            last = len(order) - 1
+            swap = random.randint(start, last)
+            order[last], order[swap] = order[swap], path
+            slots[order[last]], slots[path] = last, swap
+        self.next_round = None
+
+    def set_shuffle(self, on, paths=()):
+        """Shuffles paths, the library's tracks, into a new order that starts with the current song, or goes back to view order."""
+        self.next_round = None
+        if not on:
+            self.order = self.slots = None
+            self.pos = self.current
+            return
+        self.order, self.slots, self.pos = [], {}, -1
+        if self.current != -1:
+            path = self.songs[self.current].path
+            self.order, self.slots, self.pos = [path], {path: 0}, 0
+        self.add(paths)
+
+    @property
+    def shuffled(self):
+        return self.order is not None
+
+    def enqueue(self, index, next=False):
+        path = self.songs[index].path
+        if next:
+            self.up_next.appendleft(path)
+        else:
+            self.up_next.append(path)
+
+    def jump(self, index):
+        """Makes songs[index] current, as when the user picks it; the order carries on from there."""
+        self.current, self.pos = index, self._slot(index)
+        self._played(index)
+        return index
+
+    def next_index(self, repeat_mode="none", manual=False):
+        """Index of the song that plays after the current one, or None to stop, without moving on."""
+        return self._next(repeat_mode, manual)[0]
+
+    def advance(self, repeat_mode="none", manual=False):
+        """Moves on to the next song and returns its index, or None to stop. manual skips a repeat-one and wraps."""
+        index, source, pos = self._next(repeat_mode, manual)
+        if source == "up_next":
+            self.up_next.popleft()
+        elif source == "order":
+            self.pos = pos
+        elif source == "wrap":
+            if self.order is not None:
+                self._set_order(self.next_round)
+            self.pos, self.next_round = pos, None
+        if index is not None:
+            self.current = index
+            self._played(index)
+        return index
+
+    def previous(self):
+        """Steps back to the song that played before the current one, or else to the one before it in the order."""
+        while len(self.history) > 1:
+            self.history.pop()
+            index = self.index_of(self.history[-1])
+            if index != -1:
+                self.current, self.pos = index, self._slot(index)
+                return index
+        if not self.songs:
+            return None
+        if self.order is None:
+            self.pos = self.current = self.pos - 1 if self.pos > 0 else len(self.songs) - 1
+        else:
+            found = (self._find(range(self.pos - 1, -1, -1), self.order)
+                     or self._find(range(len(self.order) - 1, max(self.pos, 0) - 1, -1), self.order))
+            if found is None:
+                return None
+            self.pos, self.current = found
+        self.history.clear()
+        self._played(self.current)
+        return self.current
+
+    def _next(self, repeat_mode, manual):
+        """Returns (index, source, pos): the next song, where it comes from and the place in the order it is at."""
+        if not self.songs:
+            return None, None, None
+        while self.up_next:
+            index = self.index_of(self.up_next[0])
+            if index != -1:
+                return index, "up_next", None
+            self.up_next.popleft()  # no longer on view
+        if repeat_mode == "one" and not manual and self.current != -1:
+            return self.current, "repeat", None
+        if self.order is None:
+            if self.pos + 1 < len(self.songs):
+                return self.pos + 1, "order", self.pos + 1
+            return (0, "wrap", 0) if repeat_mode == "all" or manual else (None, None, None)
+        found = self._find(range(self.pos + 1, len(self.order)), self.order)
+        if found is not None:
+            return found[1], "order", found[0]
+        if repeat_mode != "all" and not manual:
+            return None, None, None
+        if self.next_round is None:
+            # Repeat-all deals a fresh shuffle for every round, never starting on the song that just ended.
+            self.next_round = list(self.order)
+            random.shuffle(self.next_round)
+            first = self._find(range(len(self.next_round)), self.next_round)
+            if first is not None and first[1] == self.current and len(self.songs) > 1:
+                self.next_round.append(self.next_round.pop(first[0]))
+        found = self._find(range(len(self.next_round)), self.next_round)
+        return (found[1], "wrap", found[0]) if found is not None else (None, None, None)
+
+    def _find(self, places, order):
+        """Returns (pos, index) of the first path of order at places that is on view, or None."""
+        index_of = self.index_of
+        for pos in places:
+            index = index_of(order[pos])
+            if index != -1:
+                return pos, index
+        return None
+
+    def _slot(self, index):
+        if self.order is None or index == -1:
+            return index
+        path = self.songs[index].path
+        if path not in self.slots:
+            self.add([path])
+        return self.slots[path]
+
+    def _set_order(self, order):
+        self.order = order
+        self.slots = {path: pos for pos, path in enumerate(order)}
+
+    def _played(self, index):
+        path = self.songs[index].path
+        if not self.history or self.history[-1] != path:
+            self.history.append(path)
+
+
+class Library:
+    """The songs below the library roots, the playlists and the song list on view, without any UI.
+
+    view_base holds the songs of the open playlist (or of the whole library), view_songs puts them in sort_order
+    and songs narrows that down to the ones matching query. current_index points into songs and keeps following
+    the current song through sorts, searches and scans. queue decides what plays next without reordering songs.
+    """
+
+    def __init__(self, index_path=LIBRARY_INDEX_PATH, playlists_path=PLAYLISTS_DB_PATH):
+        self.roots = []
+        self.index = LibraryIndex(index_path)
+        self.playlists = PlaylistStore(playlists_path)
+        self.state = None
+        self.scan = None
+        self.tracks = {}
+        self.search_index = SearchIndex()
+        self.playlist_name = ALL_SONGS
+        self.sort_order = "Name"
+        self.query = ""
+        self.view_base = self.view_songs = self.songs = []
+        self.sort_cache = {}
+        self.view_positions = None
+        self.current_index = -1
+        self.repeat_mode = "none"
+        self.queue = PlayQueue()
+        self.restoring = None
+
+    def current_song(self):
+        return self.songs[self.current_index] if 0 <= self.current_index < len(self.songs) else None
+
+    def load(self, roots, from_index=False):
+        """Forgets the songs of the old roots and starts a full scan of the new ones; drain() takes in its results."""
+        self.cancel_scan()
+        self.restoring = None
+        self.roots = roots
+        self.state = None
+        self.tracks = {}
+        self.search_index = SearchIndex()
+        self.playlist_name = ALL_SONGS
+        self.view_base = self.view_songs = self.songs = []
+        self.sort_cache = {}
+        self.view_positions = None
+        self.current_index = -1
+        self.queue.reset()
+        if roots:
+            self.scan = LibraryScan(roots, index_path=self.index.db_path, from_index=from_index)
+            self.scan.start()
+
+    def session(self):
+        """Returns what restore() needs to bring back the library, the view and the current song."""
+        if self.restoring is not None:
+            # Until drain() has reopened it, the session being restored is still the one to keep.
+            return dict(self.restoring)
+        current = self.current_song()
+        return {"roots": self.roots, "playlist": self.playlist_name, "sort_order": self.sort_order, "query": self.query,
+                "current": current.path if current else None, "shuffle": self.queue.shuffled, "repeat_mode": self.repeat_mode}
+
+    def restore(self, session):
+        """Loads a session() from the library index without opening any audio file; drain() reopens its view.
+
+        The index may be behind the disk, so a rescan() once drain() has finished brings in what changed since.
+        """
+        self.load(session.get("roots", []), from_index=True)
+        self.restoring = session
+        self.query = session.get("query", "")
+        if session.get("repeat_mode") in ("none", "all", "one"):
+            self.repeat_mode = session["repeat_mode"]
+        if session.get("playlist") in self.playlists.names():
+            self.playlist_name = session["playlist"]
+
+    def rescan(self, check_files=False):
+        """Starts a background rescan that only reports differences, unless a scan is running or none has finished yet.
+
+        Without check_files only directories are stat'ed, so files whose tags were edited in place are left for a
+        later rescan with it.
+        """
+        if self.scan is not None or self.state is None:
+            return False
+        self.scan = LibraryScan(self.roots, self.state, report_unchanged=False, check_files=check_files)
+        self.scan.start()
+        return True
+
+    def cancel_scan(self):
+        if self.scan:
+            self.scan.cancel()
+            self.scan = None
+
+    @perf.timed("library.drain")
+    def drain(self, budget=0.03):
+        """Takes in the results the scan has ready for up to budget seconds; returns True once it has finished."""
+        scan = self.scan
+        if scan is None:
+            return True
+        added, modified, changed, prepared, finished = [], {}, [], {}, False
+        deadline = time.perf_counter() + budget
+        while time.perf_counter() < deadline:
+            try:
+                item = scan.results.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                finished = True
+                break
+            song, entry, replaced, prepared[song.path] = item
+            if entry:
+                changed.append(entry)
+                scan.done += 1
+            if replaced and not scan.report_unchanged:
+                modified[song.path] = song
+            else:
+                added.append(song)
+        if changed:
+            self.index.store(changed)
+        removed = set()
+        if finished:
+            self.index.remove(scan.removed)
+            self.index.store_dirs(scan.changed_dirs, scan.removed_dirs)
+            removed = set(scan.removed)
+        self.apply_changes(added, modified, removed, prepared, streaming=scan.report_unchanged and not finished)
+        if finished:
+            self.scan = None
+            self.state = scan.state
+            if scan.report_unchanged:
+                self.migrate_playlists()
+                self.select_playlist(self.playlist_name)
+            if self.restoring is not None:
+                self._reopen(self.restoring)
+        return finished
+
+    def _reopen(self, session):
+        self.restoring = None
+        if session.get("sort_order") in SORT_ORDERS and session["sort_order"] != self.sort_order:
+            self.sort(session["sort_order"])
+        index = self.index_of(session.get("current"))
+        if index != -1:
+            self.jump(index)
+        self.set_shuffle(bool(session.get("shuffle")))
+
+    def apply_changes(self, added, modified, removed, prepared=None, streaming=False):
+        """Folds scan results into the track table and the view without rebuilding either from disk."""
+        for path in removed:
+            self.tracks.pop(path, None)
+        self.tracks.update(modified)
+        self.tracks.update((song.path, song) for song in added)
+        self.queue.add(song.path for song in added)
+        self.search_index.remove(removed)
+        new_songs = added + list(modified.values())
+        self.search_index.add(new_songs, [prepared[song.path] for song in new_songs] if prepared else None)
+        if modified or removed:
+            self.view_base = [modified.get(s.path, s) for s in self.view_base if s.path not in removed]
+        if self.playlist_name != ALL_SONGS:
+            playlist_paths = set(self.playlists.tracks(self.playlist_name)) if added else ()
+            added = [s for s in added if s.path in playlist_paths]
+        self.view_base.extend(added)
+        if not (added or modified or removed):
+            return
+        self.sort_cache = {}
+        if not streaming:
+            self.sort(self.sort_order)
+        elif not (self.view_songs is self.view_base and self.songs is self.view_base):
+            # While the first scan streams in, songs are shown in arrival order and sorted once it completes.
+            self.view_songs = self.view_base
+            self.refresh()
+        else:
+            self.current_index = self.queue.set_songs(self.songs, self.current_song())
+
+    def migrate_playlists(self):
+        """Resolves bare filenames left by the old playlist format to the paths of the library tracks they match."""
+        if not self.playlists.has_unresolved():
+            return
+        by_filename = {}
+        for path, song in self.tracks.items():
+            by_filename.setdefault(song.filename, []).append(path)
+        self.playlists.resolve_filenames(by_filename)
+
+    @perf.timed("library.import_m3u")
+    def import_m3u(self, m3u_path, name):
+        """Adds the entries of an M3U/M3U8 file to playlist name, creating it if needed, in one pass and one transaction.
+
+        An entry resolves to the track at its path or, failing that, to the only track with its filename, which
+        finds files whose library has moved. Returns the added paths and the unresolved (line_no, entry) pairs.
+        """
+        tracks = self.tracks
+        by_filename = {}
+        for path, song in tracks.items():
+            key = song.filename.casefold()
+            by_filename[key] = None if key in by_filename else path
+        unresolved = []
+
+        def resolve():
+            for line_no, entry in read_m3u(m3u_path):
+                path = entry if entry in tracks else by_filename.get(re.split(r"[\\/]", entry)[-1].casefold())
+                if path is None:
+                    unresolved.append((line_no, entry))
+                else:
+                    yield path
+
+        self.playlists.create(name)
+        added = self.playlists.append(name, resolve())
+        if name == self.playlist_name:
+            self.reload_playlist()
+        return added, unresolved
+
+    def export_m3u(self, m3u_path, name):
+        """Writes playlist name as an M3U file and returns its length; ALL_SONGS writes the songs on view while it is open."""
+        if name == ALL_SONGS:
+            songs = self.songs if self.playlist_name == ALL_SONGS else self.tracks.values()
+            entries = [(song.path, song) for song in songs]
+        else:
+            entries = [(track, self.tracks.get(track)) for track in self.playlists.tracks(name)]
+        write_m3u(m3u_path, entries)
+        return len(entries)
+
+    def remove_from_playlist(self, songs):
+        """Takes songs out of the open playlist with a single write."""
+        if self.playlist_name != ALL_SONGS and songs:
+            self.playlists.remove(self.playlist_name, [song.path for song in songs])
+            self.reload_playlist()
+
+    def move_in_playlist(self, songs, offset):
+        """Moves songs offset places within the open playlist with a single write."""
+        if self.playlist_name != ALL_SONGS and songs:
+            self.playlists.move(self.playlist_name, [song.path for song in songs], offset)
+            self.reload_playlist()
+
+    def reload_playlist(self):
+        """Re-reads the open playlist after an edit, keeping its sort order."""
+        self.select_playlist(self.playlist_name, self.sort_order)
+
+    @perf.timed("library.select_playlist")
+    def select_playlist(self, name, sort_order=None):
+        # Playlists hold track paths, so a view switch is one dictionary lookup per entry and never touches the files.
+        self.playlist_name = name
+        if name == ALL_SONGS:
+            self.view_base = list(self.tracks.values())
+            if self.sort_order == "Playlist Order":
+                self.sort_order = "Name"
+        else:
+            tracks = self.tracks
+            self.view_base = [tracks[path] for path in self.playlists.tracks(name) if path in tracks]
+            self.sort_order = "Playlist Order"
+        self.sort_cache = {}
+        self.sort(sort_order or self.sort_order)
+
+    @perf.timed("library.sort")
+    def sort(self, sort_order):
+        """Orders the view by one of SORT_ORDERS; each order is computed once per view."""
+        self.sort_order = sort_order
+        ordered = self.sort_cache.get(sort_order)
+        if ordered is None:
+            fields = SORT_ORDERS.get(sort_order, SORT_ORDERS["Name"])
+            ordered = self.view_base
+            if fields:
+                # Keys are zipped from one column per field; the path closes every key so ties always come out in the same order.
+                keys = list(zip(*(sort_column(self.view_base, field) for field in (*fields, 'path'))))
+                ordered = [self.view_base[i] for i in sorted(range(len(keys)), key=keys.__getitem__)]
+            self.sort_cache[sort_order] = ordered
+        self.view_songs = ordered
+        self.refresh()
+
+    @perf.timed("library.search")
+    def search(self, query):
+        self.query = query
+        self.refresh(view_changed=False)
+
+    def refresh(self, view_changed=True):
+        """Narrows view_songs down to the search results, keeping track of the current song."""
+        current = self.current_song()
+        if view_changed:
+            self.view_positions = None
+        matches = self.search_index.search(self.query)
+        if matches is None:
+            self.songs = self.view_songs
+        elif len(matches) * 4 < len(self.view_songs):
+            # Few hits: place them by their position in the view instead of walking the whole view.
+            if self.view_positions is None:
+                self.view_positions = {song.path: i for i, song in enumerate(self.view_songs)}
+            positions = self.view_positions
+            self.songs = [self.view_songs[i] for i in sorted(positions[path] for path in matches if path in positions)]
+        else:
+            self.songs = [song for song in self.view_songs if song.path in matches]
+        self.current_index = self.queue.set_songs(self.songs, current)
+
+    def index_of(self, path):
+        return self.queue.index_of(path)
+
+    def set_shuffle(self, on):
+        self.queue.set_shuffle(on, self.tracks)
+
+    def peek_next(self):
+        return self.queue.next_index(self.repeat_mode)
+
+    def advance(self, manual=False):
+        """Makes the song that plays next current and returns its index, or None at the end of the view."""
+        index = self.queue.advance(self.repeat_mode, manual)
+        if index is not None:
+            self.current_index = index
+        return index
+
+    def previous(self):
+        index = self.queue.previous()
+        if index is not None:
+            self.current_index = index
+        return index
+
+    def jump(self, index):
+        self.current_index = self.queue.jump(index)
+        return index
+
+
+def load_session(path=SESSION_PATH):
+    """Returns the session saved at path, or an empty one when there is none."""
+    try:
+        with open(path, "r") as f:
+            session = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return session if isinstance(session, dict) else {}
+
+
+def save_session(session, path=SESSION_PATH):
+    # Written next to the old file and renamed over it, so a crash mid-write never leaves half a session.
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(session, f, indent=2)
+    os.replace(temp_path, path)
+
+
+class Player:
+    """pygame.mixer.music plus the bookkeeping it lacks.
+
+    get_pos() counts from the last play() call and ignores set_pos(), so position() adds back the offset playback
+    started at, or that seek() moved it by. The
+    mixer holds at most one queued track, which it starts on its own when the current one ends; queued is the
+    song handed to it and becomes current once poll_end() reports the switch.
+
+    The mixer is only opened by the first play(), which keeps importing pygame and opening the audio device out
+    of the way of startup. With end_events it then posts end_event when a track ends; otherwise, or where that is
+    unavailable, poll_end() falls back to get_busy.
+    """
+
+    def __init__(self, end_events=True):
+        self.music = None
+        self.events = None
+        self.end_event = None
+        self.want_end_events = end_events
+        self.volume = 1.0
+        self.gain = 1.0
+        self.current = None
+        self.queued = None
+        self.seek_offset = 0
+        self.last_raw_pos = 0
+        self.can_set_pos = True
+        self.stream = None
+
+    def _open(self):
+        if self.music is None:
+            import pygame
+            pygame.mixer.init()
+            self.music, self.events = pygame.mixer.music, pygame.event
+            self.music.set_volume(min(1.0, self.volume * self.gain))
+            # SDL's Cocoa video backend competes with Tk for the main thread, so macOS polls instead.
+            if self.want_end_events and sys.platform != "darwin":
+                try:
+                    pygame.display.init()
+                    self.music.set_endevent(pygame.USEREVENT + 1)
+                    self.end_event = pygame.USEREVENT + 1
+                except pygame.error:
+                    pass
+        return self.music
+
+    def play(self, song, start=0):
+        music = self._open()
+        music.load(song.path)
+        music.play(start=start)
+        self._started(song, start)
+
+    def _started(self, song, start, stream=None):
+        if self.end_event is not None:
+            self.events.clear(self.end_event)  # stopping the previous track posts one too
+        if self.stream is not None:
+            self.stream.close()
+        self.current, self.queued, self.stream = song, None, stream
+        self.seek_offset, self.last_raw_pos = start, 0
+
+    def seek(self, seconds, paused=False):
+        """Moves the current track to seconds without touching its tags or art.
+
+        set_pos() repositions the decoder in place and keeps the queued track. Where the mixer cannot do that for
+        a file, VBR tracks restart from the byte their seek table maps seconds to, and other tracks are reloaded
+        with a start position; either way the queued track is dropped and has to be queued again.
+        """
+        song = self.current
+        if song is None or self.music is None:
+            return
+        if self.can_set_pos:
+            try:
+                raw = self.music.get_pos() / 1000
+                self.music.set_pos(seconds)
+                self.seek_offset, self.last_raw_pos = seconds - raw, raw
+                return
+            except RuntimeError:  # pygame.error: not supported by this codec or SDL_mixer build
+                self.can_set_pos = False
+        offset = song.seek_byte(seconds)
+        if offset is not None:
+            stream = open(song.path, "rb")
+            stream.seek(offset)
+            self.music.load(stream, "mp3")
+            self.music.play()
+            self._started(song, seconds, stream)
+        else:
+            self.play(song, seconds)
+        if paused:
+            self.music.pause()
+
+    def queue(self, song):
+        """Hands song to the mixer to follow the current track; a queued song can be replaced but not withdrawn."""
+        self.queued = song
+        if song is not None:
+            try:
+                self._open().queue(song.path)
+            except RuntimeError:  # pygame.error
+                self.queued = None
+
+    def pause(self):
+        if self.music is not None:
+            self.music.pause()
+
+    def unpause(self):
+        if self.music is not None:
+            self.music.unpause()
+
+    def stop(self):
+        if self.music is not None:
+            self.music.stop()
+        if self.stream is not None:
+            self.stream.close()
+        self.current = self.queued = self.stream = None
+
+    def busy(self):
+        return self.music is not None and self.music.get_busy()
+
+    def set_volume(self, volume):
+        self.volume = volume
+        if self.music is not None:
+            self.music.set_volume(min(1.0, self.volume * self.gain))
+
+    def set_gain(self, db):
+        """Scales the volume by a gain in dB; the mixer cannot go above full volume, so boosts are capped there."""
+        self.gain = 10 ** (db / 20)
+        self.set_volume(self.volume)
+
+    def position(self):
+        if self.music is not None:
+            self.last_raw_pos = self.music.get_pos() / 1000
+        return self.seek_offset + self.last_raw_pos
+
+    def poll_end(self):
+        """Returns "advanced" once the mixer has moved on to the queued track, "ended" once it stopped, else None."""
+        music = self.music
+        if music is None:
+            return None
+        if self.end_event is not None:
+            if not self.events.get(self.end_event):
+                return None
+        # The mixer restarts its position count when it switches to the queued track on its own.
+        elif music.get_busy() and music.get_pos() / 1000 + 0.5 >= self.last_raw_pos:
+            return None
+        if not music.get_busy():
+            return "ended"
+        self.current, self.queued = self.queued, None
+        self.seek_offset, self.last_raw_pos = 0, 0
+        return "advanced"
@@ -1,12 +1,284 @@
+import time
+STARTED = time.perf_counter()  # before the imports below, so that startup timings include them
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-import pygame
+from tkinter import font as tkfont
 import os
-import json
-import io
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB
-from PIL import Image, ImageTk, ImageDraw
+import argparse
+from nacsa_engine import (ALL_SONGS, ART_CACHE_DIR, ART_SIZE, LEGACY_PLAYLISTS_PATH, SORT_ORDERS, ArtCache, Library,
+                          LoudnessAnalyzer, Player, load_session, perf, save_session)
+
+LIBRARY_POLL_INTERVAL_MS = 30000
+LIBRARY_FILE_CHECK_INTERVAL_S = 600
+PERF_PANEL_REFRESH_MS = 1000
+SEEK_INTERVAL_MS = 100
+END_POLL_INTERVAL_MS = 100
+LOGO_PATH = "app_logo.png"
+REPEAT_LABELS = {"none": "🔁", "all": "🔁:", "one": "🔂1"}
+GAIN_LABELS = {"off": "Gain: Off", "track": "Gain: Track", "album": "Gain: Album"}
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def photo_image(image):
+    from PIL import ImageTk
+    return ImageTk.PhotoImage(image)
+
+
+def logo_thumbnail(size, logo_path=LOGO_PATH, cache_dir=ART_CACHE_DIR):
+    """Returns the path of a size x size PNG of the logo, resized with PIL only when it is missing or stale."""
+    cache_path = os.path.join(cache_dir, f"app_logo_{size}.png")
+    logo_mtime = os.stat(logo_path).st_mtime
+    try:
+        if os.stat(cache_path).st_mtime >= logo_mtime:
+            return cache_path
+    except OSError:
+        pass
+    from PIL import Image
+    os.makedirs(cache_dir, exist_ok=True)
+    with Image.open(logo_path) as img:
+        img.resize((size, size), Image.Resampling.LANCZOS).save(cache_path)
+    return cache_path
+
+
+class SongListView(tk.Frame):
+    """Multi-column song list that only creates canvas items for the rows on screen.
+
+    The view keeps a reference to the backing list of songs and redraws the visible slice from it, so
+    sorting, filtering or appending to that list costs a redraw of one screenful, not one widget per song.
+    The selection and scroll position are kept across set_rows() calls. The selection is a set of songs, so
+    Ctrl-click, Shift-click and Ctrl-A can select thousands of rows without a per-row lookup when drawing;
+    selected is the row the keyboard moves from and anchor the end a Shift-click range starts at.
+    """
+    COLUMNS = (("TITLE", 0.42), ("ARTIST", 0.25), ("ALBUM", 0.25), ("TIME", 0.08))
+
+    def __init__(self, master, font, on_activate=None, on_context_menu=None, bg="#1a1a1a", fg="white", select_bg="#00FFFF", select_fg="black", header_fg="#00FFFF"):
+        super().__init__(master, bg=bg)
+        self.font = tkfont.Font(font=font)
+        self.row_height = self.font.metrics("linespace") + 4
+        self.char_width = max(1, self.font.measure("0"))
+        self.on_activate = on_activate
+        self.on_context_menu = on_context_menu
+        self.bg, self.fg, self.select_bg, self.select_fg = bg, fg, select_bg, select_fg
+        self.rows = []
+        self.top = 0
+        self.selected = None
+        self.selected_song = None
+        self.selection = set()
+        self.anchor = None
+        self.slots = []
+        self.column_x = [0] * len(self.COLUMNS)
+        self.column_chars = [1] * len(self.COLUMNS)
+
+        self.header = tk.Canvas(self, bg=bg, height=self.row_height, highlightthickness=0, borderwidth=0)
+        self.header.pack(side=tk.TOP, fill=tk.X)
+        self.header_items = [self.header.create_text(0, self.row_height // 2, anchor="w", text=title, fill=header_fg, font=self.font)
+                             for title, _ in self.COLUMNS]
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview, style="Vertical.TScrollbar")
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas = tk.Canvas(self, bg=bg, highlightthickness=0, borderwidth=0, takefocus=1)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.canvas.bind("<Configure>", self._layout)
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<Double-Button-1>", self._on_double_click)
+        self.canvas.bind("<Shift-Button-1>", self._on_shift_click)
+        self.canvas.bind("<Button-3>", self._on_right_click)
+        if self.tk.call("tk", "windowingsystem") == "aqua":
+            self.canvas.bind("<Button-2>", self._on_right_click)
+            self.canvas.bind("<Control-Button-1>", self._on_right_click)
+            self.canvas.bind("<Command-Button-1>", self._on_toggle_click)
+            self.canvas.bind("<Command-a>", lambda e: self.select_all())
+        else:
+            self.canvas.bind("<Control-Button-1>", self._on_toggle_click)
+            self.canvas.bind("<Control-a>", lambda e: self.select_all())
+        self.canvas.bind("<MouseWheel>", lambda e: self._scroll_by(-3 if e.delta > 0 else 3))
+        self.canvas.bind("<Button-4>", lambda e: self._scroll_by(-3))
+        self.canvas.bind("<Button-5>", lambda e: self._scroll_by(3))
+        self.canvas.bind("<Up>", lambda e: self._move_selection(-1))
+        self.canvas.bind("<Down>", lambda e: self._move_selection(1))
+        self.canvas.bind("<Prior>", lambda e: self._move_selection(-self._visible_rows()))
+        self.canvas.bind("<Next>", lambda e: self._move_selection(self._visible_rows()))
+        self.canvas.bind("<Return>", lambda e: self._activate())
+
+    def set_rows(self, rows):
+        """Shows rows, keeping the selected songs selected if they are still present."""
+        self.rows = rows
+        self.selected = None
+        if self.selected_song is not None:
+            self.selected = next((i for i, song in enumerate(rows) if song is self.selected_song), None)
+        self.anchor = self.selected
+        self.top = max(0, min(self.top, len(rows) - self._visible_rows()))
+        if self.selected is not None and not self.top <= self.selected < self.top + self._visible_rows():
+            self.see(self.selected)
+        else:
+            self.refresh()
+
+    def refresh(self):
+        """Redraws the visible rows from the backing list, e.g. after songs were appended to it."""
+        rows, top = self.rows, self.top
+        for slot, (rect, texts) in enumerate(self.slots):
+            index = top + slot
+            if index < len(rows):
+                song = rows[index]
+                selected = song in self.selection
+                self.canvas.itemconfigure(rect, fill=self.select_bg if selected else self.bg)
+                for column, text in enumerate(texts):
+                    self.canvas.itemconfigure(text, text=self._cell(song, column), fill=self.select_fg if selected else self.fg)
+            else:
+                self.canvas.itemconfigure(rect, fill=self.bg)
+                for text in texts:
+                    self.canvas.itemconfigure(text, text="")
+        if rows:
+            self.scrollbar.set(top / len(rows), min(1.0, (top + self._visible_rows()) / len(rows)))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+    def curselection(self):
+        """Returns the indices of the selected rows in list order."""
+        selected = self.selected
+        if len(self.selection) == 1 and selected is not None and selected < len(self.rows) and self.rows[selected] in self.selection:
+            return (selected,)
+        return tuple(i for i, song in enumerate(self.rows) if song in self.selection) if self.selection else ()
+
+    def selected_songs(self):
+        return [self.rows[i] for i in self.curselection()]
+
+    def selection_set(self, index):
+        """Selects the row at index alone."""
+        self.selected = self.anchor = index
+        self.selected_song = self.rows[index] if index is not None and index < len(self.rows) else None
+        self.selection = {self.selected_song} if self.selected_song is not None else set()
+        self.refresh()
+
+    def select_all(self):
+        self.selection = set(self.rows)
+        self.refresh()
+
+    def see(self, index):
+        visible = self._visible_rows()
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + visible:
+            self.top = index - visible + 1
+        self.top = max(0, min(self.top, len(self.rows) - visible))
+        self.refresh()
+
+    def yview(self, *args):
+        if args and args[0] == "moveto":
+            self.top = int(float(args[1]) * len(self.rows))
+            self._scroll_by(0)
+        elif args and args[0] == "scroll":
+            self._scroll_by(int(args[1]) * (self._visible_rows() if args[2] == "pages" else 1))
+
+    def _cell(self, song, column):
+        if column == 0:
+            return self._clip(song.title, column)
+        if column == 1:
+            return self._clip(song.artist, column)
+        if column == 2:
+            return self._clip(song.album, column)
+        return format_time(song.length) if song.length else ""
+
+    def _clip(self, text, column):
+        limit = self.column_chars[column]
+        return text if len(text) <= limit else text[:max(0, limit - 1)] + "…"
+
+    def _visible_rows(self):
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def _layout(self, event):
+        x = 6
+        for column, (_, share) in enumerate(self.COLUMNS):
+            self.column_x[column] = x
+            self.column_chars[column] = max(1, int(event.width * share) // self.char_width - 1)
+            self.header.coords(self.header_items[column], x, self.row_height // 2)
+            x += int(event.width * share)
+        needed = event.height // self.row_height + 1
+        while len(self.slots) < needed:
+            y = len(self.slots) * self.row_height
+            rect = self.canvas.create_rectangle(0, y, event.width, y + self.row_height, width=0, fill=self.bg)
+            texts = [self.canvas.create_text(0, y + self.row_height // 2, anchor="w", font=self.font, fill=self.fg)
+                     for _ in self.COLUMNS]
+            self.slots.append((rect, texts))
+        while len(self.slots) > needed:
+            rect, texts = self.slots.pop()
+            self.canvas.delete(rect, *texts)
+        for slot, (rect, texts) in enumerate(self.slots):
+            y = slot * self.row_height
+            self.canvas.coords(rect, 0, y, event.width, y + self.row_height)
+            for column, text in enumerate(texts):
+                self.canvas.coords(text, self.column_x[column], y + self.row_height // 2)
+        self._scroll_by(0)
+
+    def _scroll_by(self, rows):
+        self.top = max(0, min(self.top + rows, len(self.rows) - self._visible_rows()))
+        self.refresh()
+
+    def _row_at(self, y):
+        index = self.top + int(y // self.row_height)
+        return index if index < len(self.rows) else None
+
+    def _on_click(self, event):
+        self.canvas.focus_set()
+        index = self._row_at(event.y)
+        if index is not None:
+            self.selection_set(index)
+
+    def _on_toggle_click(self, event):
+        self.canvas.focus_set()
+        index = self._row_at(event.y)
+        if index is not None:
+            song = self.rows[index]
+            self.selection ^= {song}
+            self.anchor = index
+            if song in self.selection:
+                self.selected, self.selected_song = index, song
+            else:
+                # The keyboard row moves to a song that is still selected, if any is.
+                remaining = self.curselection()
+                self.selected = remaining[0] if remaining else None
+                self.selected_song = self.rows[self.selected] if remaining else None
+            self.refresh()
+
+    def _on_shift_click(self, event):
+        self.canvas.focus_set()
+        index = self._row_at(event.y)
+        if index is None:
+            return
+        if self.anchor is None or self.anchor >= len(self.rows):
+            self.selection_set(index)
+            return
+        low, high = sorted((self.anchor, index))
+        self.selection = set(self.rows[low:high + 1])
+        self.selected, self.selected_song = index, self.rows[index]
+        self.refresh()
+
+    def _on_right_click(self, event):
+        index = self._row_at(event.y)
+        if index is not None:
+            # A right-click inside a multiple selection acts on all of it.
+            if self.rows[index] not in self.selection:
+                self.selection_set(index)
+            if self.on_context_menu:
+                self.on_context_menu(event)
+
+    def _on_double_click(self, event):
+        if self._row_at(event.y) is not None:
+            self._activate()
+
+    def _move_selection(self, delta):
+        if self.rows:
+            self.selection_set(max(0, min(len(self.rows) - 1, (self.selected if self.selected is not None else -1) + delta)))
+            self.see(self.selected)
+
+    def _activate(self):
+        if self.on_activate and self.curselection():
+            self.on_activate()
+
 
 class NACSATunes:
     def __init__(self, root):
@@ -15,7 +287,7 @@ class NACSATunes:
         self.root.geometry("1300x750")
         self.root.configure(bg="#000000")
 
-        pygame.mixer.init()
+        self.player = Player()
 
         # --- NEW: Attributes for app logo ---
         self.app_icon = None
@@ -26,52 +298,92 @@ class NACSATunes:
         if self.app_icon:
             self.root.iconphoto(False, self.app_icon)
 
-        self.current_folder = ""
-        self.songs = []
-        self.current_song_index = -1
+        self.library = Library()
+        self.loudness = LoudnessAnalyzer(self.library.index.db_path)
+        self.gain_mode = "off"
         self.is_playing = False
         self.is_paused = False
-        self.repeat_mode = "none"
-        self.custom_playlists = {}
-        self.current_playlist_name = "All Songs"
         self.song_length = 0
         self.current_position = 0
-        self.seek_offset = 0
+        self.resume_position = None
+        self.files_checked_at = time.monotonic()
+        self.gapless = False
+        self.ui_after_id = None
+        self.seek_after_id = None
+        self.seek_target = None
 
         self.album_art_label = None
         self.album_art_photo = None
-        self.default_art_path = "default_album_art.png"
-        self.create_default_album_art()
+        self.art_cache = ArtCache(make_photo=photo_image)
+        self.default_art_photo = None
+
+        self.perf_panel = None
 
         self.setup_ui()
         self.load_playlists()
-        self.update_ui()
+        self.root.bind("<F12>", lambda e: self.show_perf_panel())
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(LIBRARY_POLL_INTERVAL_MS, self.poll_library)
+        self.root.after_idle(self.on_started)
 
     # --- NEW: Method to load the application logo ---
     def load_app_logo(self):
-        """Loads the app_logo.png file and creates PhotoImage objects for the icon and header."""
+        """Loads the window icon and the header logo from small copies of app_logo.png, which Tk reads without PIL."""
         try:
             # Load the main icon for the window title bar
-            icon_image = Image.open("app_logo.png")
-            self.app_icon = ImageTk.PhotoImage(icon_image)
+            self.app_icon = tk.PhotoImage(file=logo_thumbnail(64))
 
-            # Load and resize the logo for the header
-            logo_image = icon_image.resize((50, 50), Image.Resampling.LANCZOS)
-            self.app_logo_photo = ImageTk.PhotoImage(logo_image)
+            # Load the logo for the header
+            self.app_logo_photo = tk.PhotoImage(file=logo_thumbnail(50))
         except FileNotFoundError:
             print("Warning: app_logo.png not found. The application will run without the logo.")
         except Exception as e:
             print(f"Error loading app_logo.png: {e}")
 
-    def create_default_album_art(self):
-        if not os.path.exists(self.default_art_path):
-            try:
-                img = Image.new('RGB', (300, 300), color='#1a1a1a')
-                d = ImageDraw.Draw(img)
-                d.text((120, 140), "No Art", fill='#00FFFF')
-                img.save(self.default_art_path)
-            except Exception as e:
-                print(f"Could not create default album art: {e}")
+    def on_started(self):
+        """Runs once the window is up: records how long that took and brings back the last session."""
+        perf.record("startup.window", (time.perf_counter() - STARTED) * 1000, blocking=False)
+        session = load_session()
+        if session.get("roots") and not self.library.roots:
+            self.volume_slider.set(session.get("volume", 0.5))
+            self.player.set_volume(session.get("volume", 0.5))
+            if session.get("gapless", False) != self.gapless:
+                self.toggle_gapless()
+            if session.get("gain_mode") in GAIN_LABELS:
+                self.gain_mode = session["gain_mode"]
+                self.gain_btn.config(text=GAIN_LABELS[self.gain_mode])
+            self.load_songs_from_folder(session["roots"], session)
+
+    def on_restored(self, session):
+        """Shows the view and song of a restored session and starts the rescan that catches up with the disk."""
+        perf.record("startup.restored", (time.perf_counter() - STARTED) * 1000, blocking=False)
+        library = self.library
+        self.search_var.set(library.query)
+        self.shuffle_btn.config(fg="#00FFFF" if library.queue.shuffled else "grey")
+        self.repeat_btn.config(text=REPEAT_LABELS[library.repeat_mode])
+        song = library.current_song()
+        if song is not None:
+            self.update_song_info(song)
+            self.current_position = self.resume_position = min(session.get("position", 0), song.length or 0)
+            self.show_position()
+        if library.rescan(check_files=True):
+            self.root.after(50, self._drain_scan, library.scan)
+
+    def write_session(self):
+        session = self.library.session()
+        if self.library.restoring is None:
+            session["position"] = self.current_position if self.library.current_song() else 0
+        session.update(volume=float(self.volume_slider.get()), gapless=self.gapless, gain_mode=self.gain_mode)
+        try:
+            save_session(session)
+        except OSError as e:
+            print(f"Could not save the session: {e}")
+
+    def on_close(self):
+        self.write_session()
+        self.cancel_scan()
+        self.loudness.cancel()
+        self.root.destroy()
 
     def setup_ui(self):
         try:
@@ -110,6 +422,12 @@ class NACSATunes:
         left_panel = tk.Frame(main_frame, bg="#000000", width=250)
         left_panel.pack(side=tk.LEFT, fill=tk.Y, padx=(0, 20))
         tk.Button(left_panel, text="Select Music Folder", command=self.select_folder, bg="#1a1a1a", fg="#00FFFF", font=self.text_font).pack(pady=(10, 5), fill=tk.X)
+        self.add_folder_btn = tk.Button(left_panel, text="Add Music Folder", command=self.add_folder, bg="#1a1a1a", fg="#00FFFF", font=self.text_font)
+        self.add_folder_btn.pack(pady=(0, 5), fill=tk.X)
+        self.scan_frame = tk.Frame(left_panel, bg="#000000")
+        self.scan_status_label = tk.Label(self.scan_frame, text="", bg="#000000", fg="grey", anchor="w", justify=tk.LEFT, wraplength=180)
+        self.scan_status_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(self.scan_frame, text="Cancel", command=self.cancel_scan, bg="#333333", fg="white").pack(side=tk.RIGHT)
         tk.Label(left_panel, text="PLAYLISTS", bg="#000000", fg="#00FFFF", font=self.bold_text_font).pack(pady=(20, 5), fill=tk.X)
         self.playlist_listbox = tk.Listbox(left_panel, bg="#1a1a1a", fg="white", selectbackground="#00FFFF", selectforeground="black", borderwidth=0, highlightthickness=0)
         self.playlist_listbox.pack(fill=tk.BOTH, expand=True)
@@ -119,6 +437,10 @@ class NACSATunes:
         self.new_playlist_entry = tk.Entry(add_playlist_frame, bg="#1a1a1a", fg="white", insertbackground="white")
         self.new_playlist_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
         tk.Button(add_playlist_frame, text="Create", command=self.create_playlist, bg="#00FFFF", fg="black").pack(side=tk.RIGHT, padx=(5,0))
+        m3u_frame = tk.Frame(left_panel, bg="#000000")
+        m3u_frame.pack(pady=(0, 5), fill=tk.X)
+        tk.Button(m3u_frame, text="Import M3U", command=self.import_m3u, bg="#1a1a1a", fg="#00FFFF").pack(side=tk.LEFT, expand=True, fill=tk.X)
+        tk.Button(m3u_frame, text="Export M3U", command=self.export_m3u, bg="#1a1a1a", fg="#00FFFF").pack(side=tk.LEFT, expand=True, fill=tk.X, padx=(5, 0))
 
         right_panel = tk.Frame(main_frame, bg="#000000")
         right_panel.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
@@ -131,8 +453,12 @@ class NACSATunes:
         song_list_header_frame = tk.Frame(list_container_frame, bg="#000000")
         song_list_header_frame.pack(fill=tk.X, pady=(10, 5))
         tk.Label(song_list_header_frame, text="SONG LIBRARY", bg="#000000", fg="#00FFFF", font=self.header_font).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Label(song_list_header_frame, text="Search:", bg="#000000", fg="white").pack(side=tk.LEFT, padx=(10, 5))
+        self.search_var = tk.StringVar()
+        self.search_var.trace_add("write", self.on_search_changed)
+        tk.Entry(song_list_header_frame, textvariable=self.search_var, bg="#1a1a1a", fg="white", insertbackground="white", width=24).pack(side=tk.LEFT)
         tk.Label(song_list_header_frame, text="Sort by:", bg="#000000", fg="white").pack(side=tk.LEFT, padx=(10, 5))
-        self.sort_option_menu = ttk.Combobox(song_list_header_frame, values=["Name", "Title", "Artist", "Album"], state="readonly", width=8)
+        self.sort_option_menu = ttk.Combobox(song_list_header_frame, values=list(SORT_ORDERS), state="readonly", width=18)
         self.sort_option_menu.set("Name")
         self.sort_option_menu.pack(side=tk.LEFT)
         self.sort_option_menu.bind("<<ComboboxSelected>>", self.sort_songs)
@@ -142,16 +468,12 @@ class NACSATunes:
         style = ttk.Style()
         style.theme_use("clam")
         style.configure("Vertical.TScrollbar", troughcolor="#000000", background="#1a1a1a", bordercolor="#1a1a1a", arrowcolor="#00FFFF")
-        self.song_listbox = tk.Listbox(song_list_frame, bg="#1a1a1a", fg="white", selectbackground="#00FFFF", selectforeground="black", borderwidth=0, highlightthickness=0)
+        self.song_listbox = SongListView(song_list_frame, font=self.text_font, on_activate=self.play_selected_song, on_context_menu=self.show_song_menu)
         self.song_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        self.song_listbox.bind("<Double-Button-1>", self.play_selected_song)
-        scrollbar = ttk.Scrollbar(song_list_frame, orient="vertical", command=self.song_listbox.yview, style="Vertical.TScrollbar")
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.song_listbox.config(yscrollcommand=scrollbar.set)
 
         art_frame = tk.Frame(top_right_frame, bg="#000000")
         art_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(20, 0), pady=(10, 0))
-        self.album_art_label = tk.Label(art_frame, bg="#000000")
+        self.album_art_label = tk.Label(art_frame, bg="#000000", fg="#00FFFF", compound="center")
         self.album_art_label.pack()
         self.update_album_art(None)
 
@@ -168,6 +490,8 @@ class NACSATunes:
         self.progress_bar.pack(fill=tk.X, pady=(0, 5))
         self.progress_bar.config(maximum=100)
         self.progress_bar.bind("<Button-1>", self.seek_song)
+        self.progress_bar.bind("<B1-Motion>", self.seek_song)
+        self.progress_bar.bind("<ButtonRelease-1>", self.end_seek)
         time_frame = tk.Frame(controls_container, bg="#000000")
         time_frame.pack(fill=tk.X)
         self.current_time_label = tk.Label(time_frame, text="0:00", bg="#000000", fg="white")
@@ -183,69 +507,163 @@ class NACSATunes:
         tk.Button(central_controls_frame, text="⏭️", command=self.play_next, bg="#1a1a1a", fg="#00FFFF", font=("Arial", 16), width=3).pack(side=tk.LEFT, padx=10)
         self.repeat_btn = tk.Button(central_controls_frame, text="🔁", command=self.toggle_repeat, bg="#1a1a1a", fg="#00FFFF", font=("Arial", 16), width=3)
         self.repeat_btn.pack(side=tk.LEFT, padx=10)
-        tk.Button(central_controls_frame, text="🔀", command=self.shuffle_songs, bg="#1a1a1a", fg="#00FFFF", font=("Arial", 16), width=3).pack(side=tk.LEFT, padx=10)
+        self.shuffle_btn = tk.Button(central_controls_frame, text="🔀", command=self.shuffle_songs, bg="#1a1a1a", fg="grey", font=("Arial", 16), width=3)
+        self.shuffle_btn.pack(side=tk.LEFT, padx=10)
+        self.gapless_btn = tk.Button(central_controls_frame, text="Gapless: Off", command=self.toggle_gapless, bg="#1a1a1a", fg="#00FFFF")
+        self.gapless_btn.pack(side=tk.LEFT, padx=10)
+        self.gain_btn = tk.Button(central_controls_frame, text=GAIN_LABELS[self.gain_mode], command=self.toggle_gain, bg="#1a1a1a", fg="#00FFFF")
+        self.gain_btn.pack(side=tk.LEFT, padx=10)
         volume_frame = tk.Frame(central_controls_frame, bg="#000000")
         volume_frame.pack(side=tk.LEFT, padx=15)
         tk.Label(volume_frame, text="Volume", bg="#000000", fg="white").pack(side=tk.LEFT, padx=5)
         style.configure("TScale", background="#000000", troughcolor="#1a1a1a", sliderrelief="flat")
         self.volume_slider = ttk.Scale(volume_frame, from_=0, to=1, orient="horizontal", command=self.set_volume, style="TScale")
         self.volume_slider.set(0.5)
-        pygame.mixer.music.set_volume(0.5)
+        self.player.set_volume(0.5)
         self.volume_slider.pack(side=tk.LEFT, padx=5)
 
+    def schedule_ui_update(self):
+        """Arms the next progress tick, or none at all while nothing is playing."""
+        if self.ui_after_id is not None:
+            self.root.after_cancel(self.ui_after_id)
+            self.ui_after_id = None
+        if not self.is_playing:
+            return
+        if self.song_length > 0:
+            # One tick per pixel the bar advances, but at least once a second for the time label.
+            bar_width = max(1, self.progress_bar.winfo_width())
+            interval = min(1000, max(100, self.song_length * 1000 / bar_width))
+            remaining = (self.song_length - self.current_position) * 1000
+            # Tk only hears of the end, by event or by the mixer going idle, on a tick, so one lands just after
+            # the estimated end and the ticks stay short until the track has really stopped.
+            if remaining > 0:
+                interval = max(20, min(interval, remaining + 20))
+            else:
+                interval = min(interval, END_POLL_INTERVAL_MS)
+        else:
+            interval = 500
+        self.ui_after_id = self.root.after(int(interval), self.update_ui)
+
+    def show_position(self):
+        if self.song_length > 0:
+            self.progress_bar.config(value=(self.current_position / self.song_length) * 100)
+        self.current_time_label.config(text=format_time(self.current_position))
+
+    @perf.timed()
     def update_ui(self):
-        if self.is_playing and not pygame.mixer.music.get_busy():
+        self.ui_after_id = None
+        if not self.is_playing:
+            return
+        ended = self.player.poll_end()
+        if ended == "advanced":
+            self.on_queued_song_started()
+        elif ended == "ended":
             self.handle_song_end()
-        elif self.is_playing:
-            raw_pos = pygame.mixer.music.get_pos() / 1000
-            self.current_position = self.seek_offset + raw_pos
+        elif self.seek_target is not None:
+            self.schedule_ui_update()  # the marker already shows where the pending seek lands
+        else:
+            self.current_position = self.player.position()
             self.current_position = min(self.current_position, self.song_length) if self.song_length > 0 else 0
-            if self.song_length > 0:
-                progress_percentage = (self.current_position / self.song_length) * 100
-                self.progress_bar.config(value=progress_percentage)
-            minutes, seconds = divmod(int(self.current_position), 60)
-            self.current_time_label.config(text=f"{minutes}:{seconds:02d}")
-        self.root.after(200, self.update_ui)
+            self.show_position()
+            self.schedule_ui_update()
 
     def select_folder(self):
         folder_path = filedialog.askdirectory()
         if folder_path:
-            self.current_folder = folder_path
-            self.load_songs_from_folder()
-
-    def load_songs_from_folder(self):
-        self.songs.clear()
-        if self.current_folder:
-            supported_formats = (".mp3",)
-            for filename in os.listdir(self.current_folder):
-                if filename.endswith(supported_formats):
-                    path = os.path.join(self.current_folder, filename)
-                    try:
-                        audio = ID3(path)
-                        title = audio.get('TIT2', [filename])[0]
-                        artist = audio.get('TPE1', ['Unknown Artist'])[0]
-                        album = audio.get('TALB', ['Unknown Album'])[0]
-                    except Exception:
-                        title, artist, album = filename, "Unknown Artist", "Unknown Album"
-                    self.songs.append({'filename': filename, 'path': path, 'title': title, 'artist': artist, 'album': album})
-        if not self.songs and self.current_folder:
-            messagebox.showinfo("NACSA Tunes", "No supported MP3 files found for sorting.")
-        self.sort_songs()
-        self.current_playlist_name = "All Songs"
-        self.populate_playlists()
+            self.load_songs_from_folder([os.path.abspath(folder_path)])
+
+    def add_folder(self):
+        folder_path = filedialog.askdirectory()
+        if folder_path and os.path.abspath(folder_path) not in self.library.roots:
+            self.load_songs_from_folder(self.library.roots + [os.path.abspath(folder_path)])
+
+    @perf.timed()
+    def load_songs_from_folder(self, roots, session=None):
+        """Scans roots, or with a saved session, reopens it from the library index."""
+        self.cancel_scan()
+        self.reset_now_playing()
+        if session:
+            self.library.restore(session)
+        else:
+            self.library.load(roots)
+        self.song_listbox.set_rows(self.library.songs)
+        if self.library.scan is None:
+            return
+        self.scan_frame.pack(fill=tk.X, after=self.add_folder_btn)
+        self.scan_status_label.config(text="Restoring..." if session else "Scanning...")
+        self.root.after(0 if session else 50, self._drain_scan, self.library.scan, session)
+
+    def poll_library(self):
+        """Periodically rescans the roots in the background and applies only the differences to the song lists.
 
-    def update_listbox(self):
-        self.song_listbox.delete(0, tk.END)
-        for song in self.songs:
-            self.song_listbox.insert(tk.END, song['title'] if song['title'] != song['filename'] else song['filename'])
+        Most polls only stat directories; every LIBRARY_FILE_CHECK_INTERVAL_S one also stats each file, which
+        catches tags edited in place.
+        """
+        check_files = time.monotonic() - self.files_checked_at >= LIBRARY_FILE_CHECK_INTERVAL_S
+        if self.library.rescan(check_files):
+            if check_files:
+                self.files_checked_at = time.monotonic()
+            self.root.after(50, self._drain_scan, self.library.scan)
+        self.write_session()
+        self.root.after(LIBRARY_POLL_INTERVAL_MS, self.poll_library)
 
+    @perf.timed()
+    def _drain_scan(self, scan, session=None):
+        if scan is not self.library.scan:
+            return
+        finished = self.library.drain()
+        if not finished:
+            self.loudness.hold()
+            self.view_changed()
+            if scan.report_unchanged and not scan.from_index:
+                self.scan_status_label.config(text=f"Scanning... {len(self.library.tracks)} songs\n{scan.done}/{scan.total} tagged ({scan.throughput():.0f} files/s)")
+            self.root.after(50, self._drain_scan, scan, session)
+            return
+        self.view_changed(show_current=True)
+        if scan.report_unchanged or scan.total or scan.removed:
+            self.loudness.analyze(self.library.state)
+        if scan.report_unchanged:
+            self.scan_frame.pack_forget()
+            self.sort_option_menu.set(self.library.sort_order)
+            if not self.library.tracks and not scan.from_index:
+                messagebox.showinfo("NACSA Tunes", "No supported MP3 files found for sorting.")
+            self.populate_playlists()
+        if session:
+            self.on_restored(session)
+
+    def cancel_scan(self):
+        self.library.cancel_scan()
+        self.scan_frame.pack_forget()
+
+    @perf.timed()
+    def view_changed(self, show_current=False):
+        """Shows the library's song list after a change and re-queues the song that follows the current one."""
+        songs = self.library.songs
+        if self.song_listbox.rows is songs:
+            self.song_listbox.refresh()
+        else:
+            self.song_listbox.set_rows(songs)
+        if show_current and self.library.current_index != -1:
+            self.song_listbox.selection_set(self.library.current_index)
+            self.song_listbox.see(self.library.current_index)
+        self.queue_next_song()
+
+    @perf.timed()
+    def on_search_changed(self, *args):
+        self.library.search(self.search_var.get())
+        self.view_changed()
+
+    @perf.timed()
     def sort_songs(self, event=None):
-        sort_by = self.sort_option_menu.get()
-        sort_key = {'Name': 'filename', 'Title': 'title', 'Artist': 'artist', 'Album': 'album'}.get(sort_by, 'filename')
-        self.songs.sort(key=lambda x: str(x[sort_key]).lower())
-        self.update_listbox()
-        pygame.mixer.music.stop()
+        """Orders the view by the chosen sort without interrupting playback."""
+        self.library.sort(self.sort_option_menu.get())
+        self.view_changed(show_current=True)
+
+    def reset_now_playing(self):
+        self.player.stop()
         self.is_playing, self.is_paused = False, False
+        self.current_position, self.resume_position = 0, None
+        self.schedule_ui_update()
         self.play_pause_btn.config(text="▶️")
         self.current_song_label.config(text="No song selected")
         self.metadata_label.config(text="Artist: N/A | Album: N/A")
@@ -254,178 +672,310 @@ class NACSATunes:
         self.total_time_label.config(text="0:00")
         self.update_album_art(None)
 
+    @perf.timed()
     def play_song(self, song_index, start_pos=0):
-        if not self.songs or not (0 <= song_index < len(self.songs)):
+        songs = self.library.songs
+        if song_index is None or not (0 <= song_index < len(songs)):
             return
-        self.current_song_index = song_index
-        song_data = self.songs[self.current_song_index]
+        if song_index != self.library.queue.current:
+            self.library.jump(song_index)
+        song_data = songs[song_index]
+        self.resume_position = None
+        self.loudness.hold()
+        self.apply_gain(song_data)
         try:
-            pygame.mixer.music.load(song_data['path'])
-            self.seek_offset = start_pos
-            pygame.mixer.music.play(start=start_pos)
+            self.player.play(song_data, start_pos)
+            self.current_position = start_pos
             self.is_playing, self.is_paused = True, False
             self.play_pause_btn.config(text="⏸️")
             self.update_song_info(song_data)
-        except pygame.error as e:
-            messagebox.showerror("Playback Error", f"Could not play {song_data['filename']}: {e}")
+            self.queue_next_song()
+            self.schedule_ui_update()
+        except RuntimeError as e:  # pygame.error
+            messagebox.showerror("Playback Error", f"Could not play {song_data.filename}: {e}")
 
     def update_song_info(self, song_data):
-        self.current_song_label.config(text=song_data['title'])
-        self.metadata_label.config(text=f"ARTIST: {song_data['artist']} | ALBUM: {song_data['album']}")
-        self.get_song_length(song_data['path'])
-        self.update_album_art(song_data['path'])
+        self.current_song_label.config(text=song_data.title)
+        self.metadata_label.config(text=f"ARTIST: {song_data.artist} | ALBUM: {song_data.album}")
+        self.get_song_length(song_data)
+        self.update_album_art(song_data)
 
-    def get_song_length(self, full_path):
-        try:
-            self.song_length = MP3(full_path).info.length
-            minutes, seconds = divmod(int(self.song_length), 60)
-            self.total_time_label.config(text=f"{minutes}:{seconds:02d}")
-        except Exception:
-            self.song_length = 0
-            self.total_time_label.config(text="0:00")
-
-    def update_album_art(self, full_path):
-        try:
-            image_data = None
-            if full_path:
-                audio = ID3(full_path)
-                image_data = next((tag.data for key, tag in audio.items() if key.startswith("APIC")), None)
-            if image_data:
-                img = Image.open(io.BytesIO(image_data))
-            else:
-                img = Image.open(self.default_art_path)
-            img = img.resize((300, 300), Image.Resampling.LANCZOS)
-            self.album_art_photo = ImageTk.PhotoImage(img)
-            self.album_art_label.config(image=self.album_art_photo)
-            self.album_art_label.image = self.album_art_photo
-        except Exception:
-            img = Image.open(self.default_art_path)
-            img = img.resize((300, 300), Image.Resampling.LANCZOS)
-            self.album_art_photo = ImageTk.PhotoImage(img)
-            self.album_art_label.config(image=self.album_art_photo)
-            self.album_art_label.image = self.album_art_photo
+    @perf.timed()
+    def get_song_length(self, song_data):
+        self.song_length = song_data.length
+        self.total_time_label.config(text=format_time(self.song_length))
+
+    @perf.timed()
+    def update_album_art(self, song_data):
+        photo = None
+        if song_data and song_data.art_key:
+            try:
+                photo = self.art_cache.photo(song_data)
+            except Exception:
+                photo = None
+        caption = ""
+        if photo is None:
+            if self.default_art_photo is None:
+                # A blank tile drawn by Tk itself, with the caption as label text on top; no image file or PIL needed.
+                self.default_art_photo = tk.PhotoImage(width=ART_SIZE[0], height=ART_SIZE[1])
+                self.default_art_photo.put("#1a1a1a", to=(0, 0, *ART_SIZE))
+            photo, caption = self.default_art_photo, "No Art"
+        self.album_art_photo = photo
+        self.album_art_label.config(image=self.album_art_photo, text=caption)
+        self.album_art_label.image = self.album_art_photo
 
     def seek_song(self, event):
+        """Moves the marker to the pointer at once; the player follows at most once per SEEK_INTERVAL_MS while dragging."""
         if self.song_length > 0 and (self.is_playing or self.is_paused):
             bar_width = self.progress_bar.winfo_width()
             if bar_width > 0:
-                was_paused = self.is_paused
-                new_time = (event.x / bar_width) * self.song_length
-                self.play_song(self.current_song_index, start_pos=new_time)
-                if was_paused:
-                    pygame.mixer.music.pause()
-                    self.is_playing, self.is_paused = False, True
-                    self.play_pause_btn.config(text="▶️")
+                new_time = min(max(event.x / bar_width, 0), 1) * self.song_length
+                self.seek_target = (self.player.current, new_time)
+                self.current_position = new_time
+                self.show_position()
+                if self.seek_after_id is None:
+                    self.apply_seek()
+
+    def end_seek(self, event):
+        if self.seek_target is not None and self.seek_after_id is not None:
+            self.root.after_cancel(self.seek_after_id)
+            self.apply_seek()
+
+    @perf.timed()
+    def apply_seek(self):
+        """Hands the latest seek target to the player, which repositions the stream without reloading tags or art."""
+        self.seek_after_id = None
+        if self.seek_target is None:
+            return
+        (song_data, new_time), self.seek_target = self.seek_target, None
+        if song_data is not self.player.current or not (self.is_playing or self.is_paused):
+            return
+        self.loudness.hold()
+        try:
+            self.player.seek(new_time, paused=self.is_paused)
+        except (RuntimeError, OSError) as e:  # pygame.error
+            messagebox.showerror("Playback Error", f"Could not seek in {song_data.filename}: {e}")
+            return
+        self.current_position = new_time
+        self.queue_next_song()
+        self.schedule_ui_update()
+        self.seek_after_id = self.root.after(SEEK_INTERVAL_MS, self.apply_seek)
 
     def toggle_play_pause(self):
-        if not pygame.mixer.music.get_busy() and not self.is_paused:
-            if self.songs: self.play_song(0)
+        if not self.player.busy() and not self.is_paused:
+            if self.resume_position is not None and self.library.current_song() is not None:
+                self.play_song(self.library.current_index, start_pos=self.resume_position)
+            elif self.library.songs: self.play_song(self.library.advance(manual=True))
             return
         if self.is_playing:
-            pygame.mixer.music.pause()
+            self.player.pause()
             self.is_paused, self.is_playing = True, False
             self.play_pause_btn.config(text="▶️")
         elif self.is_paused:
-            pygame.mixer.music.unpause()
+            self.player.unpause()
             self.is_paused, self.is_playing = False, True
             self.play_pause_btn.config(text="⏸️")
+        self.schedule_ui_update()
 
     def play_selected_song(self, event=None):
         selected_index = self.song_listbox.curselection()
-        if selected_index: self.play_song(selected_index[0])
+        if selected_index: self.play_song(self.library.jump(selected_index[0]))
+
+    def queue_next_song(self):
+        """Hands the song that will follow to the mixer in gapless mode and prefetches its art."""
+        next_index = self.library.peek_next()
+        next_song = self.library.songs[next_index] if next_index is not None else None
+        if next_song is not None:
+            self.art_cache.prefetch(next_song)
+        if not self.gapless or not (self.is_playing or self.is_paused) or next_song is self.player.queued:
+            return
+        # A queued song can only be replaced, not withdrawn; on_queued_song_started stops one that is no longer wanted.
+        self.player.queue(next_song)
+
+    def on_queued_song_started(self):
+        song_data = self.player.current
+        index = self.library.advance()
+        if index is None or self.library.songs[index] is not song_data:
+            # The mixer started a song queued before the play order changed; the order wins.
+            self.player.stop()
+            if index is not None:
+                self.play_song(index)
+            else:
+                self.finish_playback()
+            return
+        self.current_position = 0
+        self.apply_gain(song_data)
+        self.update_song_info(song_data)
+        self.queue_next_song()
+        self.schedule_ui_update()
+
+    def toggle_gapless(self):
+        self.gapless = not self.gapless
+        self.gapless_btn.config(text="Gapless: On" if self.gapless else "Gapless: Off")
+        self.queue_next_song()
+
+    def toggle_gain(self):
+        modes = list(GAIN_LABELS)
+        self.gain_mode = modes[(modes.index(self.gain_mode) + 1) % len(modes)]
+        self.gain_btn.config(text=GAIN_LABELS[self.gain_mode])
+        if self.player.current is not None:
+            self.apply_gain(self.player.current)
+
+    def apply_gain(self, song_data):
+        """Sets the stored track or album gain of song_data; songs not analysed yet play unchanged."""
+        self.player.set_gain(self.loudness.gain(song_data, self.gain_mode))
 
     def play_next(self):
-        if not self.songs: return
-        next_index = self.current_song_index + 1 if self.current_song_index != -1 else 0
-        if next_index >= len(self.songs): next_index = 0
-        self.play_song(next_index)
+        if not self.library.songs: return
+        self.play_song(self.library.advance(manual=True))
 
     def play_previous(self):
-        if not self.songs: return
-        prev_index = self.current_song_index - 1
-        if prev_index < 0: prev_index = len(self.songs) - 1
-        self.play_song(prev_index)
-        
+        if not self.library.songs: return
+        self.play_song(self.library.previous())
+
     def handle_song_end(self):
-        if self.repeat_mode == "one":
-            self.play_song(self.current_song_index)
-        elif self.repeat_mode == "all":
-            self.play_next()
+        next_index = self.library.advance()
+        if next_index is not None:
+            self.play_song(next_index)
         else:
-            if self.current_song_index < len(self.songs) - 1:
-                self.play_next()
-            else:
-                self.is_playing = False
-                self.play_pause_btn.config(text="▶️")
-                self.current_song_label.config(text="Playlist Finished")
-                self.progress_bar.config(value=0)
-                self.current_time_label.config(text="0:00")
+            self.finish_playback()
+
+    def finish_playback(self):
+        self.is_playing = False
+        self.current_position = 0
+        self.play_pause_btn.config(text="▶️")
+        self.current_song_label.config(text="Playlist Finished")
+        self.progress_bar.config(value=0)
+        self.current_time_label.config(text="0:00")
 
     def toggle_repeat(self):
-        if self.repeat_mode == "none":
-            self.repeat_mode, text = "all", "Repeat All: The current playlist will loop."
-            self.repeat_btn.config(text="🔁:")
-        elif self.repeat_mode == "all":
-            self.repeat_mode, text = "one", "Repeat One: The current song will repeat."
-            self.repeat_btn.config(text="🔂1")
+        library = self.library
+        if library.repeat_mode == "none":
+            library.repeat_mode, text = "all", "Repeat All: The current playlist will loop."
+        elif library.repeat_mode == "all":
+            library.repeat_mode, text = "one", "Repeat One: The current song will repeat."
         else:
-            self.repeat_mode, text = "none", "Repeat is off."
-            self.repeat_btn.config(text="🔁")
+            library.repeat_mode, text = "none", "Repeat is off."
+        self.repeat_btn.config(text=REPEAT_LABELS[library.repeat_mode])
+        self.queue_next_song()
         messagebox.showinfo("Repeat Mode", text)
 
     def shuffle_songs(self):
-        import random
-        if self.songs:
-            random.shuffle(self.songs)
-            self.update_listbox()
-            messagebox.showinfo("Shuffle", "Current queue has been shuffled.")
+        """Toggles shuffled playback; the list keeps its order and only the play queue is shuffled."""
+        queue = self.library.queue
+        self.library.set_shuffle(not queue.shuffled)
+        self.shuffle_btn.config(fg="#00FFFF" if queue.shuffled else "grey")
+        self.queue_next_song()
 
-    def set_volume(self, value):
-        pygame.mixer.music.set_volume(float(value))
+    def show_song_menu(self, event):
+        menu = tk.Menu(self.root, tearoff=0, bg="#1a1a1a", fg="white", activebackground="#00FFFF", activeforeground="black")
+        menu.add_command(label="Play", command=self.play_selected_song)
+        menu.add_command(label="Play Next", command=lambda: self.enqueue_selected(next=True))
+        menu.add_command(label="Add to Queue", command=self.enqueue_selected)
+        menu.add_separator()
+        menu.add_command(label="Add to Playlist...", command=self.add_to_playlist)
+        if self.library.playlist_name != ALL_SONGS:
+            menu.add_command(label="Remove from Playlist", command=self.remove_selected_from_playlist)
+            if self.library.sort_order == "Playlist Order":
+                menu.add_command(label="Move Up", command=lambda: self.move_selected(-1))
+                menu.add_command(label="Move Down", command=lambda: self.move_selected(1))
+        try:
+            menu.tk_popup(event.x_root, event.y_root)
+        finally:
+            menu.grab_release()
 
-    def load_playlists(self):
+    def enqueue_selected(self, next=False):
+        selected_index = self.song_listbox.curselection()
+        if selected_index:
+            # Play Next puts each song in front of the queue, so they go in back to front to keep their order.
+            for index in reversed(selected_index) if next else selected_index:
+                self.library.queue.enqueue(index, next=next)
+            self.queue_next_song()
+
+    def remove_selected_from_playlist(self):
+        songs = self.song_listbox.selected_songs()
+        if songs and messagebox.askyesno("Remove from Playlist", f"Remove {len(songs)} song(s) from '{self.library.playlist_name}'?"):
+            self.library.remove_from_playlist(songs)
+            self.view_changed(show_current=True)
+
+    def move_selected(self, offset):
+        songs = self.song_listbox.selected_songs()
+        if songs:
+            self.library.move_in_playlist(songs, offset)
+            self.view_changed()
+            self.song_listbox.see(self.song_listbox.selected if self.song_listbox.selected is not None else 0)
+
+    def import_m3u(self):
+        m3u_path = filedialog.askopenfilename(filetypes=[("M3U playlists", "*.m3u *.m3u8"), ("All files", "*.*")])
+        if not m3u_path:
+            return
+        base = os.path.splitext(os.path.basename(m3u_path))[0] or "Imported"
+        names, name, n = set(self.library.playlists.names()), base, 1
+        while name in names or name == ALL_SONGS:
+            n += 1
+            name = f"{base} ({n})"
         try:
-            with open("playlists.json", "r") as f: self.custom_playlists = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError): self.custom_playlists = {}
+            added, unresolved = self.library.import_m3u(m3u_path, name)
+        except OSError as e:
+            messagebox.showerror("Import Error", f"Could not read {m3u_path}: {e}")
+            return
         self.populate_playlists()
+        text = f"Added {len(added)} songs to '{name}'."
+        if unresolved:
+            text += f"\n\n{len(unresolved)} entries did not match a single library song:\n"
+            text += "\n".join(f"line {line_no}: {entry}" for line_no, entry in unresolved[:15])
+            if len(unresolved) > 15:
+                text += f"\n... and {len(unresolved) - 15} more"
+        messagebox.showinfo("Import M3U", text)
+
+    def export_m3u(self):
+        name = self.library.playlist_name
+        m3u_path = filedialog.asksaveasfilename(defaultextension=".m3u8", initialfile=f"{name}.m3u8",
+                                                filetypes=[("M3U8 playlist", "*.m3u8"), ("M3U playlist", "*.m3u")])
+        if not m3u_path:
+            return
+        try:
+            count = self.library.export_m3u(m3u_path, name)
+        except OSError as e:
+            messagebox.showerror("Export Error", f"Could not write {m3u_path}: {e}")
+            return
+        messagebox.showinfo("Export M3U", f"Wrote {count} songs of '{name}' to {m3u_path}.")
 
-    def save_playlists(self):
-        with open("playlists.json", "w") as f: json.dump(self.custom_playlists, f, indent=4)
+    def set_volume(self, value):
+        self.player.set_volume(float(value))
+
+    def load_playlists(self):
+        # Only the names are read here; a playlist's tracks are fetched when it is opened.
+        self.library.playlists.import_json(LEGACY_PLAYLISTS_PATH)
+        self.populate_playlists()
 
     def populate_playlists(self):
         self.playlist_listbox.delete(0, tk.END)
-        self.playlist_listbox.insert(tk.END, "All Songs")
-        for playlist_name in self.custom_playlists.keys(): self.playlist_listbox.insert(tk.END, playlist_name)
+        self.playlist_listbox.insert(tk.END, ALL_SONGS)
+        for playlist_name in self.library.playlists.names(): self.playlist_listbox.insert(tk.END, playlist_name)
 
     def create_playlist(self):
         playlist_name = self.new_playlist_entry.get().strip()
-        if playlist_name and playlist_name not in self.custom_playlists and playlist_name != "All Songs":
-            self.custom_playlists[playlist_name] = []
+        if playlist_name and playlist_name != ALL_SONGS and self.library.playlists.create(playlist_name):
             self.new_playlist_entry.delete(0, tk.END)
-            self.save_playlists()
             self.populate_playlists()
             messagebox.showinfo("Playlist", f"Playlist '{playlist_name}' created.")
         else: messagebox.showerror("Error", "Invalid or existing playlist name.")
 
+    @perf.timed()
     def on_playlist_select(self, event):
         selected_index = self.playlist_listbox.curselection()
         if not selected_index: return
-        selected_playlist_name = self.playlist_listbox.get(selected_index[0])
-        self.current_playlist_name = selected_playlist_name
-        self.load_songs_from_folder() 
-        if selected_playlist_name != "All Songs":
-            playlist_filenames = self.custom_playlists.get(selected_playlist_name, [])
-            self.songs = [s for s in self.songs if s['filename'] in playlist_filenames]
-        self.sort_songs()
+        self.library.select_playlist(self.playlist_listbox.get(selected_index[0]))
+        self.sort_option_menu.set(self.library.sort_order)
+        self.view_changed(show_current=True)
 
     def add_to_playlist(self):
-        song_index_tuple = self.song_listbox.curselection()
-        if not song_index_tuple:
+        songs = self.song_listbox.selected_songs()
+        if not songs:
             messagebox.showerror("Error", "Please select a song to add.")
             return
         
-        song_data = self.songs[song_index_tuple[0]]
-        
         dialog = tk.Toplevel(self.root)
         dialog.title("Manage Playlists")
         dialog.geometry("400x350")
@@ -444,7 +994,8 @@ class NACSATunes:
         dialog_y = root_y + (root_height - 350) // 2
         dialog.geometry(f"+{dialog_x}+{dialog_y}")
         
-        tk.Label(dialog, text=f"Add '{song_data['title'][:30]}...' to:", bg="#1a1a1a", fg="white", font=self.text_font).pack(pady=(10, 5))
+        what = f"'{songs[0].title[:30]}...'" if len(songs) == 1 else f"{len(songs)} songs"
+        tk.Label(dialog, text=f"Add {what} to:", bg="#1a1a1a", fg="white", font=self.text_font).pack(pady=(10, 5))
         
         playlist_frame = tk.Frame(dialog, bg="#1a1a1a")
         playlist_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
@@ -452,7 +1003,7 @@ class NACSATunes:
         dialog_playlist_box = tk.Listbox(playlist_frame, bg="#333333", fg="white", selectbackground="#00FFFF", selectforeground="black")
         dialog_playlist_box.pack(fill=tk.BOTH, expand=True)
         
-        custom_playlists = list(self.custom_playlists.keys())
+        custom_playlists = self.library.playlists.names()
         if not custom_playlists:
             dialog_playlist_box.insert(tk.END, "No custom playlists found.")
             dialog_playlist_box.config(state="disabled")
@@ -467,19 +1018,21 @@ class NACSATunes:
                 return
             
             playlist_name = dialog_playlist_box.get(selected_playlist_tuple[0])
-            song_filename = song_data['filename']
-
-            if song_filename not in self.custom_playlists[playlist_name]:
-                self.custom_playlists[playlist_name].append(song_filename)
-                self.save_playlists()
+            added = self.library.playlists.append(playlist_name, [song.path for song in songs])
+            if len(added) == len(songs):
                 messagebox.showinfo("Success", f"Added to '{playlist_name}'.", parent=dialog)
+            elif added:
+                messagebox.showinfo("Success", f"Added {len(added)} songs to '{playlist_name}'; the others were already in it.", parent=dialog)
             else:
-                messagebox.showinfo("Info", f"Song is already in '{playlist_name}'.", parent=dialog)
+                messagebox.showinfo("Info", f"Already in '{playlist_name}'.", parent=dialog)
+            if playlist_name == self.library.playlist_name:
+                self.library.reload_playlist()
+                self.view_changed()
             dialog.destroy()
 
         def refresh_dialog_list():
             dialog_playlist_box.delete(0, tk.END)
-            updated_custom_playlists = list(self.custom_playlists.keys())
+            updated_custom_playlists = self.library.playlists.names()
             if not updated_custom_playlists:
                 dialog_playlist_box.insert(tk.END, "No custom playlists found.")
                 dialog_playlist_box.config(state="disabled")
@@ -490,7 +1043,7 @@ class NACSATunes:
         button_frame = tk.Frame(dialog, bg="#1a1a1a")
         button_frame.pack(pady=10, fill=tk.X, padx=10)
         
-        add_btn = tk.Button(button_frame, text="Add Song", command=confirm_add, bg="#00FFFF", fg="black")
+        add_btn = tk.Button(button_frame, text="Add Song" if len(songs) == 1 else "Add Songs", command=confirm_add, bg="#00FFFF", fg="black")
         add_btn.pack(side=tk.LEFT, expand=True, padx=5)
 
         delete_btn = tk.Button(button_frame, text="Delete Playlist", command=lambda: self._confirm_delete_playlist(dialog, dialog_playlist_box, refresh_dialog_list), bg="#500000", fg="white")
@@ -499,6 +1052,34 @@ class NACSATunes:
         cancel_btn = tk.Button(button_frame, text="Cancel", command=dialog.destroy, bg="#333333", fg="white")
         cancel_btn.pack(side=tk.RIGHT, expand=True, padx=5)
 
+    def show_perf_panel(self):
+        """Opens a window with the live timings of the instrumented operations (F12)."""
+        if self.perf_panel is not None and self.perf_panel.winfo_exists():
+            self.perf_panel.lift()
+            return
+        self.perf_panel = tk.Toplevel(self.root)
+        self.perf_panel.title("Performance Stats")
+        self.perf_panel.geometry("640x420")
+        self.perf_panel.configure(bg="#1a1a1a")
+        text = tk.Text(self.perf_panel, bg="#1a1a1a", fg="white", font=("Courier", 10), borderwidth=0)
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.refresh_perf_panel(text)
+
+    def refresh_perf_panel(self, text):
+        if not self.perf_panel.winfo_exists():
+            return
+        stats = perf.summary()
+        lines = [f"{'operation':<28}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        lines += [f"{name:<28}{op['count']:>7}{op['p50_ms']:>10.1f}{op['p95_ms']:>10.1f}{op['max_ms']:>10.1f}"
+                  for name, op in stats["operations"].items()]
+        lines += ["", f"{'counter':<28}{'value':>7}"]
+        lines += [f"{name:<28}{value:>7}" for name, value in stats["counters"].items()]
+        text.config(state="normal")
+        text.delete("1.0", tk.END)
+        text.insert(tk.END, "\n".join(lines))
+        text.config(state="disabled")
+        self.root.after(PERF_PANEL_REFRESH_MS, self.refresh_perf_panel, text)
+
     def _confirm_delete_playlist(self, parent_dialog, listbox, refresh_callback):
         selected_playlist_tuple = listbox.curselection()
         if not selected_playlist_tuple:
@@ -508,15 +1089,23 @@ class NACSATunes:
         playlist_name = listbox.get(selected_playlist_tuple[0])
 
         if messagebox.askyesno("Confirm Deletion", f"Are you sure you want to permanently delete the playlist '{playlist_name}'?\nThis cannot be undone.", parent=parent_dialog):
-            if playlist_name in self.custom_playlists:
-                del self.custom_playlists[playlist_name]
-                self.save_playlists()
+            if playlist_name in self.library.playlists.names():
+                self.library.playlists.delete(playlist_name)
                 self.populate_playlists()
                 refresh_callback()
                 messagebox.showinfo("Success", f"Playlist '{playlist_name}' has been deleted.", parent=parent_dialog)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NACSA Tunes offline music player")
+    parser.add_argument("--profile", nargs="?", const="perf_stats.json", metavar="PATH",
+                        help="write timing and file read statistics as JSON to PATH (default perf_stats.json) on exit")
+    parser.add_argument("--slow-ms", type=float, default=perf.slow_ms,
+                        help="log operations that block the UI for longer than this many milliseconds (default %(default)s)")
+    args = parser.parse_args()
+    perf.slow_ms = args.slow_ms
     root = tk.Tk()
     app = NACSATunes(root)
     root.mainloop()
+    if args.profile:
+        perf.dump(args.profile)